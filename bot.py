@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 # bot.py - Новостной бот для канала "Live Питер 📸" с приоритетом картинок из новостей
-import os
 import time
+
+# Замер старта: от начала импорта модуля до готовности и первой публикации
+STARTUP_STARTED = time.perf_counter()
+STARTUP_TIMINGS = {}
+
+import os
 import json
 import random
 import asyncio
@@ -10,53 +15,213 @@ import re
 import signal
 import sys
 import socket
+import gzip
+import hashlib
+import sqlite3
+import zlib
+import argparse
+import math
+import queue
+import uuid
+import atexit
+import logging
+import contextvars
+import html
+import codecs
+import functools
+from email.utils import parsedate_to_datetime, format_datetime
+from types import SimpleNamespace
+from urllib.parse import urlparse
+from logging.handlers import QueueHandler, QueueListener
+from collections import Counter, OrderedDict, deque
 from datetime import datetime, timedelta, timezone
-from bs4 import BeautifulSoup
-from telebot.async_telebot import AsyncTeleBot
 from dotenv import load_dotenv
 
-# --- Защита от множественных запусков ---
-def check_single_instance(port=9999):
-    """Проверяет, что запущен только один экземпляр бота"""
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind(('0.0.0.0', port))
-        print("✅ Проверка единственного экземпляра: УСПЕШНО")
-        return sock
-    except socket.error:
-        print("❌ ОШИБКА: Уже запущен другой экземпляр бота!")
-        print("💡 Решение: Закройте все локальные копии бота")
-        sys.exit(1)
-
-# Проверяем при запуске
-instance_socket = check_single_instance()
-
-# Проверка и создание необходимых папок
-os.makedirs('./static', exist_ok=True)
-print(f"📁 Папка static создана/проверена")
-
-# Загрузка переменных окружения
-load_dotenv()
+def mark_startup(stage):
+    """Запомнить время этапа запуска (мс от начала импорта), только первый раз"""
+    if stage not in STARTUP_TIMINGS:
+        STARTUP_TIMINGS[stage] = round((time.perf_counter() - STARTUP_STARTED) * 1000, 1)
+        log.info(f"Этап запуска {stage}: {STARTUP_TIMINGS[stage]} мс", extra={'fields': {stage: STARTUP_TIMINGS[stage]}})
 
 # --- Конфигурация ---
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-CHANNEL_ID = os.getenv("CHANNEL_ID", "@LivePiter")
-AUTO_POST_INTERVAL = int(os.getenv("AUTO_POST_INTERVAL", "1800"))
-PORT = int(os.getenv("PORT", "10000"))
-RENDER_APP_URL = os.getenv("RENDER_APP_URL", "")
+WEBHOOK_PATH = '/telegram/webhook'
+
+def read_config():
+    """Чтение настроек из переменных окружения (без побочных эффектов, повторяется после загрузки .env)"""
+    global BOT_TOKEN, CHANNEL_ID, AUTO_POST_INTERVAL, PORT, RENDER_APP_URL
+    global HTTP_ARCHIVE_MODE, HTTP_ARCHIVE_DIR, TELEGRAM_MODE, WEBHOOK_URL, WEBHOOK_SECRET
+    global STATE_DB_PATH, LEASE_TTL, WORKER_INTERVAL, LOG_LEVEL
+    global PUBLISH_MIN_INTERVAL, PUBLISH_MAX_INTERVAL, PUBLISH_MAX_PER_SLOT, CHANNELS_FILE
+    global SOURCES_FILE, FETCH_CONCURRENCY, FEED_PARSE_WORKERS
+    global POSTED_RETENTION_DAYS, POSTED_FILTER_CAPACITY, CAPTION_LIMIT
+    global SOURCE_POLL_MIN, SOURCE_POLL_MAX, ADMIN_TOKEN, MEMORY_TRACE_FRAMES
+    
+    BOT_TOKEN = os.getenv("BOT_TOKEN")
+    CHANNEL_ID = os.getenv("CHANNEL_ID", "@LivePiter")
+    AUTO_POST_INTERVAL = int(os.getenv("AUTO_POST_INTERVAL", "1800"))
+    PORT = int(os.getenv("PORT", "10000"))
+    RENDER_APP_URL = os.getenv("RENDER_APP_URL", "")
+    # Запись/воспроизведение HTTP-трафика: "" (выключено), "record" или "replay"
+    HTTP_ARCHIVE_MODE = os.getenv("HTTP_ARCHIVE_MODE", "").strip().lower()
+    HTTP_ARCHIVE_DIR = os.getenv("HTTP_ARCHIVE_DIR", "./http_archive")
+    # Режим получения обновлений Telegram: polling (по умолчанию) или webhook на HTTP-сервере
+    TELEGRAM_MODE = os.getenv("TELEGRAM_MODE", "polling").strip().lower()
+    WEBHOOK_URL = os.getenv("WEBHOOK_URL", RENDER_APP_URL).rstrip('/')
+    # Секрет webhook: Telegram присылает его в заголовке X-Telegram-Bot-Api-Secret-Token
+    WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or (
+        hashlib.sha256(BOT_TOKEN.encode('utf-8')).hexdigest()[:32] if BOT_TOKEN else None)
+    # Общее хранилище процессов: аренда лидера и кандидаты от воркеров
+    STATE_DB_PATH = os.getenv("STATE_DB_PATH", "./bot_state.sqlite3")
+    LEASE_TTL = int(os.getenv("LEASE_TTL", "60"))
+    WORKER_INTERVAL = int(os.getenv("WORKER_INTERVAL", "600"))
+    # Границы адаптивного интервала опроса источника (начальный интервал - poll_interval из реестра)
+    SOURCE_POLL_MIN = int(os.getenv("SOURCE_POLL_MIN", "180"))
+    SOURCE_POLL_MAX = int(os.getenv("SOURCE_POLL_MAX", "10800"))
+    # Планировщик публикаций: границы интервала между слотами и максимум новостей в слоте
+    PUBLISH_MIN_INTERVAL = int(os.getenv("PUBLISH_MIN_INTERVAL", "1200"))
+    PUBLISH_MAX_INTERVAL = int(os.getenv("PUBLISH_MAX_INTERVAL", "3600"))
+    PUBLISH_MAX_PER_SLOT = int(os.getenv("PUBLISH_MAX_PER_SLOT", "2"))
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+    # Каналы: переменная CHANNELS (JSON) или файл
+    CHANNELS_FILE = os.getenv("CHANNELS_FILE", "channels.json")
+    # Реестр источников: переменная SOURCES (JSON) или файл; иначе встроенный список
+    SOURCES_FILE = os.getenv("SOURCES_FILE", "sources.json")
+    # Одновременных запросов к лентам и процессов для разбора лент (0 - разбор в основном процессе)
+    FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "10"))
+    FEED_PARSE_WORKERS = int(os.getenv("FEED_PARSE_WORKERS", "0"))
+    # Опубликованные новости помним POSTED_RETENTION_DAYS дней; емкость фильтра - на половину этого срока
+    POSTED_RETENTION_DAYS = int(os.getenv("POSTED_RETENTION_DAYS", "60"))
+    POSTED_FILTER_CAPACITY = int(os.getenv("POSTED_FILTER_CAPACITY", "50000"))
+    # Лимит подписи к фото в Telegram (символы после разбора HTML)
+    CAPTION_LIMIT = int(os.getenv("CAPTION_LIMIT", "1024"))
+    # Диагностика: токен служебных маршрутов /admin/* (без него маршруты закрыты)
+    # и глубина стека tracemalloc с запуска (0 - трассировка включается через /admin/memory?trace=start)
+    ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+    MEMORY_TRACE_FRAMES = int(os.getenv("MEMORY_TRACE_FRAMES", "0"))
+
+def validate_config():
+    """Проверка настроек перед запуском бота"""
+    if TELEGRAM_MODE not in ("polling", "webhook"):
+        raise SystemExit(f"❌ Неизвестный TELEGRAM_MODE: {TELEGRAM_MODE}")
+    if TELEGRAM_MODE == "webhook" and not WEBHOOK_URL:
+        raise SystemExit("❌ Для TELEGRAM_MODE=webhook нужен WEBHOOK_URL или RENDER_APP_URL")
+    if HTTP_ARCHIVE_MODE not in ("", "record", "replay"):
+        raise SystemExit(f"❌ Неизвестный HTTP_ARCHIVE_MODE: {HTTP_ARCHIVE_MODE}")
+    if not BOT_TOKEN:
+        raise SystemExit("❌ BOT_TOKEN не установлен")
+
+read_config()
+
+# --- Структурированное логирование: JSON-строки, вывод в отдельном потоке ---
+cycle_id_var = contextvars.ContextVar('cycle_id', default=None)
+log = logging.getLogger('live_piter')
+log_listener = None
+
+class JsonLogFormatter(logging.Formatter):
+    """Одна запись - одна JSON-строка: время, уровень, цикл, сообщение и поля события"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'msg': record.getMessage()
+        }
+        if getattr(record, 'cycle_id', None):
+            entry['cycle'] = record.cycle_id
+        entry.update(getattr(record, 'fields', None) or {})
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class CycleIdFilter(logging.Filter):
+    """Добавляет в запись идентификатор текущего цикла (читается в потоке вызывающего кода)"""
+
+    def filter(self, record):
+        record.cycle_id = cycle_id_var.get()
+        return True
+
+def setup_logging():
+    """Логи кладутся в очередь без блокировки event loop, пишет их поток QueueListener"""
+    global log_listener
+    if log_listener is not None:
+        return
+    
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(CycleIdFilter())
+    
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonLogFormatter())
+    
+    log.addHandler(queue_handler)
+    log.setLevel(LOG_LEVEL)
+    log.propagate = False
+    
+    log_listener = QueueListener(log_queue, stream_handler)
+    log_listener.start()
+    atexit.register(log_listener.stop)
 
-if not BOT_TOKEN:
-    raise SystemExit("❌ BOT_TOKEN не установлен")
+def new_cycle_id(kind):
+    """Новый идентификатор цикла для корреляции логов (наследуется задачами asyncio)"""
+    cycle_id = f"{kind}-{uuid.uuid4().hex[:8]}"
+    cycle_id_var.set(cycle_id)
+    return cycle_id
 
-# Инициализация бота
-bot = AsyncTeleBot(BOT_TOKEN)
+# --- Ленивые импорты тяжелых библиотек ---
+def load_bs4():
+    """BeautifulSoup импортируется при первом разборе HTML/RSS, а не при старте процесса"""
+    import bs4
+    return bs4
+
+# Клиент Telegram создается в startup(), импорт модуля не открывает соединений
+bot = None
+
+def create_bot():
+    """Создание клиента Telegram и регистрация команд"""
+    global bot
+    from telebot.async_telebot import AsyncTeleBot
+    bot = AsyncTeleBot(BOT_TOKEN)
+    register_handlers(bot)
+    return bot
+
+# --- Часы: реальные или виртуальные (тесты, симуляция) ---
+class SystemClock:
+    """Реальное время"""
+
+    def now(self):
+        return datetime.now(timezone.utc)
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+class VirtualClock:
+    """Виртуальное время: sleep мгновенно сдвигает часы вперед
+    
+    С until часы останавливаются на этой отметке: задача, дошедшая до нее, засыпает навсегда"""
+
+    def __init__(self, start, until=None):
+        self.current = start
+        self.until = until
+        self.reached_until = asyncio.Event()
+
+    def now(self):
+        return self.current
+
+    async def sleep(self, seconds):
+        self.current += timedelta(seconds=seconds)
+        if self.until and self.current >= self.until:
+            self.reached_until.set()
+            await asyncio.Future()
+        await asyncio.sleep(0)
+
+clock = SystemClock()
 
 # --- Глобальные переменные для управления постингом ---
 DEFAULT_PLACEHOLDER_PATH = './static/placeholder.jpg'
 DAILY_POST_COUNTER = 0
-LAST_RESET_DATE = datetime.now(timezone.utc).date()
+LAST_RESET_DATE = clock.now().date()
 MAX_DAILY_POSTS = 20
+CHANNEL_POST_COUNTERS = {}  # счетчики дополнительных каналов (основной канал - DAILY_POST_COUNTER)
+DEFAULT_POSTING_WINDOW = "07:00-23:50"
+DRY_RUN = False  # пробный прогон: posted.json и daily_stats.json не перезаписываются
 
 # --- Управление заглушкой ---
 def initialize_placeholder():
@@ -65,51 +230,169 @@ def initialize_placeholder():
     try:
         # Проверяем существование заглушки в папке static
         if os.path.exists(DEFAULT_PLACEHOLDER_PATH):
-            print("✅ Заглушка найдена в папке static")
+            log.info("Заглушка найдена в папке static")
             return True
         else:
-            print("❌ КРИТИЧЕСКАЯ ОШИБКА: Заглушка НЕ найдена в папке static")
-            print("💡 Разместите файл placeholder.jpg в папке static")
+            log.error("КРИТИЧЕСКАЯ ОШИБКА: Заглушка НЕ найдена, разместите placeholder.jpg в папке static")
             return False
     except Exception as e:
-        print(f"❌ Ошибка инициализации заглушки: {e}")
+        log.error(f"Ошибка инициализации заглушки: {e}")
         return False
 
 # --- Управление опубликованными новостями ---
+class BloomFilter:
+    """Фильтр Блума: «точно нет» или «возможно да» при фиксированном объеме памяти"""
+
+    def __init__(self, capacity, error_rate=0.01, bits=None):
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray(bits) if bits is not None else bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        # Двойное хеширование: k позиций из двух 64-битных половин одного blake2b
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+class PostedStore:
+    """Опубликованные новости: таблица posted в SQLite - источник истины, перед ней два поколения фильтра Блума
+    
+    Поколение живет половину срока хранения; при смене выпадает старшее поколение
+    и удаляются строки, которые оно покрывало, так что фильтр и таблица описывают одно множество.
+    Строки, добавленные другими процессами (лидером для воркера), фильтр догоняет по rowid таблицы."""
+
+    def __init__(self, db, capacity, retention_days):
+        self.db = db
+        self.capacity = capacity
+        self.window = retention_days * 86400 / 2
+        self.generations = []  # [(начало, фильтр)], текущее поколение первым
+        self.last_rowid = 0    # строки posted до этого rowid уже есть в фильтре
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        rows = self.db.execute(
+            'SELECT started_at, capacity, bits, last_rowid FROM posted_filter ORDER BY generation').fetchall()
+        if rows and all(capacity == self.capacity for _, capacity, _, _ in rows):
+            self.generations = [(started_at, BloomFilter(capacity, bits=bits)) for started_at, capacity, bits, _ in rows]
+            # Сохраненный фильтр не знает строк, добавленных после его записи
+            self.last_rowid = min(last_rowid or 0 for _, _, _, last_rowid in rows)
+            self.catch_up()
+        else:
+            self.rebuild()
+
+    def rebuild(self):
+        """Заполнение фильтра заново из таблицы (первый запуск или смена емкости)"""
+        self.generations = [(clock.now().timestamp(), BloomFilter(self.capacity))]
+        self.last_rowid = 0
+        self.catch_up()
+        self.dirty = True
+
+    def catch_up(self):
+        """Добавление в фильтр строк, появившихся в таблице после last_rowid; True - такие были"""
+        latest = self.db.execute('SELECT MAX(rowid) FROM posted').fetchone()[0] or 0
+        if latest <= self.last_rowid:
+            return False
+        bloom = self.generations[0][1]
+        for (key,) in self.db.execute('SELECT key FROM posted WHERE rowid > ? AND rowid <= ?', (self.last_rowid, latest)):
+            bloom.add(key)
+        self.last_rowid = latest
+        self.dirty = True
+        return True
+
+    def rotate_if_needed(self):
+        now = clock.now().timestamp()
+        current_started = self.generations[0][0]
+        if now - current_started < self.window:
+            return
+        self.db.execute('DELETE FROM posted WHERE posted_at < ?', (current_started,))
+        self.generations = [(now, BloomFilter(self.capacity)), self.generations[0]]
+        self.dirty = True
+        log.info("Фильтр опубликованных новостей: новое поколение")
+
+    def __contains__(self, key):
+        # Отрицательный ответ фильтра окончательный, если таблицу с прошлой сверки никто не пополнял;
+        # при совпадении в SQLite идем только за подтверждением
+        if not any(key in bloom for _, bloom in self.generations):
+            if not self.catch_up() or key not in self.generations[0][1]:
+                return False
+        return self.db.execute('SELECT 1 FROM posted WHERE key = ?', (key,)).fetchone() is not None
+
+    def add(self, key):
+        self.rotate_if_needed()
+        self.db.execute('INSERT OR REPLACE INTO posted (key, posted_at) VALUES (?, ?)', (key, clock.now().timestamp()))
+        self.generations[0][1].add(key)
+        self.dirty = True
+
+    def update(self, keys):
+        """Массовое добавление (перенос из posted.json)"""
+        now = clock.now().timestamp()
+        keys = list(keys)
+        self.db.executemany('INSERT OR IGNORE INTO posted (key, posted_at) VALUES (?, ?)', [(key, now) for key in keys])
+        for key in keys:
+            self.generations[0][1].add(key)
+        self.dirty = True
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM posted').fetchone()[0]
+
+    def flush(self):
+        """Сохранение фильтра (таблица posted пишется сразу при добавлении)"""
+        if not self.dirty:
+            return
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self.db.execute('DELETE FROM posted_filter')
+            self.db.executemany(
+                'INSERT INTO posted_filter (generation, started_at, capacity, bits, last_rowid) VALUES (?, ?, ?, ?, ?)',
+                [(index, started_at, self.capacity, bytes(bloom.bits), self.last_rowid)
+                 for index, (started_at, bloom) in enumerate(self.generations)]
+            )
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+        self.dirty = False
+
 def load_posted_news():
-    """Загрузка списка опубликованных новостей"""
+    """Загрузка опубликованных новостей; posted.json и POSTED_NEWS переносятся в SQLite один раз"""
+    store = PostedStore(get_state_db(), POSTED_FILTER_CAPACITY, POSTED_RETENTION_DAYS)
     try:
-        posted_json = os.getenv("POSTED_NEWS", "[]")
-        posted_set = set(json.loads(posted_json))
-        
-        if os.path.exists('posted.json'):
-            with open('posted.json', 'r', encoding='utf-8') as f:
-                file_data = json.load(f)
-                posted_set.update(file_data)
-                
-        return posted_set
+        if len(store) == 0:
+            legacy = set(json.loads(os.getenv("POSTED_NEWS", "[]")))
+            if os.path.exists('posted.json'):
+                with open('posted.json', 'r', encoding='utf-8') as f:
+                    legacy.update(json.load(f))
+            if legacy:
+                store.update(legacy)
+                store.flush()
+                log.info(f"Перенесено {len(legacy)} опубликованных новостей из posted.json в {STATE_DB_PATH}")
     except Exception as e:
-        print(f"⚠️ Ошибка загрузки posted news: {e}")
-        return set()
+        log.warning(f"Ошибка переноса posted news: {e}")
+    return store
 
-def save_posted_news(posted_news_set):
-    """Сохранение списка опубликованных новостей"""
+def save_posted_news(posted_news_store):
+    """Сохранение фильтра опубликованных новостей"""
+    if DRY_RUN:
+        return
     try:
-        posted_list = list(posted_news_set)
-        print(f"💾 Сохранено {len(posted_list)} новостей")
-        
-        os.environ["POSTED_NEWS"] = json.dumps(posted_list)
-        
-        with open('posted.json', 'w', encoding='utf-8') as f:
-            json.dump(posted_list, f, ensure_ascii=False, indent=2)
-            
+        posted_news_store.flush()
+        log.debug("Фильтр опубликованных новостей сохранен")
     except Exception as e:
-        print(f"⚠️ Ошибка сохранения posted news: {e}")
+        log.warning(f"Ошибка сохранения posted news: {e}")
 
 # --- Управление дневным лимитом постов ---
 def load_daily_stats():
     """Загрузка дневной статистики с валидацией"""
-    global DAILY_POST_COUNTER, LAST_RESET_DATE
+    global DAILY_POST_COUNTER, LAST_RESET_DATE, CHANNEL_POST_COUNTERS
     
     try:
         if os.path.exists('daily_stats.json'):
@@ -122,192 +405,828 @@ def load_daily_stats():
                 'last_reset_date' in stats):
                 
                 DAILY_POST_COUNTER = stats.get('daily_post_counter', 0)
-                LAST_RESET_DATE = datetime.fromisoformat(stats.get('last_reset_date', datetime.now(timezone.utc).isoformat())).date()
-                print(f"📊 Загружена дневная статистика: {DAILY_POST_COUNTER}/20 постов")
+                CHANNEL_POST_COUNTERS = dict(stats.get('channel_post_counters', {}))
+                LAST_RESET_DATE = datetime.fromisoformat(stats.get('last_reset_date', clock.now().isoformat())).date()
+                log.info(f"Загружена дневная статистика: {DAILY_POST_COUNTER}/{MAX_DAILY_POSTS} постов")
             else:
-                print("⚠️ Невалидные данные в daily_stats.json, сбрасываю статистику")
+                log.warning("Невалидные данные в daily_stats.json, сбрасываю статистику")
                 reset_daily_stats()
         else:
             reset_daily_stats()
             
     except Exception as e:
-        print(f"⚠️ Ошибка загрузки дневной статистики: {e}")
+        log.warning(f"Ошибка загрузки дневной статистики: {e}")
         reset_daily_stats()
 
 def reset_daily_stats():
     """Сброс дневной статистики"""
     global DAILY_POST_COUNTER, LAST_RESET_DATE
     DAILY_POST_COUNTER = 0
-    LAST_RESET_DATE = datetime.now(timezone.utc).date()
-    print("📊 Новая дневная статистика инициализирована")
+    CHANNEL_POST_COUNTERS.clear()
+    LAST_RESET_DATE = clock.now().date()
+    log.info("Новая дневная статистика инициализирована")
     save_daily_stats()
 
 def save_daily_stats():
     """Сохранение дневной статистики"""
+    if DRY_RUN:
+        return
     try:
         stats = {
             'daily_post_counter': DAILY_POST_COUNTER,
-            'last_reset_date': datetime.now(timezone.utc).isoformat(),
-            'max_daily_posts': MAX_DAILY_POSTS
+            'last_reset_date': clock.now().isoformat(),
+            'max_daily_posts': MAX_DAILY_POSTS,
+            'channel_post_counters': CHANNEL_POST_COUNTERS
         }
         
         with open('daily_stats.json', 'w', encoding='utf-8') as f:
             json.dump(stats, f, ensure_ascii=False, indent=2)
         
-        print(f"💾 Сохранена дневная статистика: {DAILY_POST_COUNTER}/20 постов")
+        log.debug("Сохранена дневная статистика: %d/%d постов", DAILY_POST_COUNTER, MAX_DAILY_POSTS)
     except Exception as e:
-        print(f"⚠️ Ошибка сохранения дневной статистики: {e}")
+        log.warning(f"Ошибка сохранения дневной статистики: {e}")
 
 def reset_daily_counter_if_needed():
     """Сброс счетчика если наступил новый день"""
     global DAILY_POST_COUNTER, LAST_RESET_DATE
     
-    current_date = datetime.now(timezone.utc).date()
+    current_date = clock.now().date()
     if current_date != LAST_RESET_DATE:
         old_count = DAILY_POST_COUNTER
         DAILY_POST_COUNTER = 0
+        CHANNEL_POST_COUNTERS.clear()
         LAST_RESET_DATE = current_date
-        print(f"🔄 Сброс дневного счетчика: {old_count} → 0 (новый день)")
+        log.info(f"Сброс дневного счетчика: {old_count} → 0 (новый день)")
         save_daily_stats()
         return True
     return False
 
-def can_post_more_today():
-    """Проверка можно ли публиковать еще посты сегодня"""
+def get_daily_post_count(channel=None):
+    """Количество постов канала за сегодня"""
+    if is_primary_channel(channel):
+        return DAILY_POST_COUNTER
+    return CHANNEL_POST_COUNTERS.get(channel['id'], 0)
+
+# Публикации в процессе: резерв квоты по каналам и занятые ключи новостей
+RESERVED_POSTS = Counter()
+CLAIMED_KEYS = set()
+
+def can_post_more_today(channel=None):
+    """Проверка можно ли публиковать еще посты сегодня (с учетом уже идущих публикаций)"""
     reset_daily_counter_if_needed()
-    return DAILY_POST_COUNTER < MAX_DAILY_POSTS
+    channel = channel or PRIMARY_CHANNEL
+    return get_daily_post_count(channel) + RESERVED_POSTS[channel['id']] < channel['max_daily_posts']
+
+def claim_posts(channels, news_id):
+    """Атомарный (без await) захват новости и резерв квоты для каналов; возвращает захваченные каналы"""
+    claimed = []
+    for channel in channels:
+        key = posted_key(channel, news_id)
+        if key in CLAIMED_KEYS or not can_post_more_today(channel):
+            continue
+        CLAIMED_KEYS.add(key)
+        RESERVED_POSTS[channel['id']] += 1
+        claimed.append(channel)
+    return claimed
+
+def release_posts(channels, news_id):
+    """Снятие захвата и резерва после отправки (успешной или нет)"""
+    for channel in channels:
+        CLAIMED_KEYS.discard(posted_key(channel, news_id))
+        RESERVED_POSTS[channel['id']] -= 1
 
-def increment_daily_counter():
+def increment_daily_counter(channel=None):
     """Увеличивает счетчик дневных постов"""
     global DAILY_POST_COUNTER
-    DAILY_POST_COUNTER += 1
+    channel = channel or PRIMARY_CHANNEL
+    if is_primary_channel(channel):
+        DAILY_POST_COUNTER += 1
+    else:
+        CHANNEL_POST_COUNTERS[channel['id']] = CHANNEL_POST_COUNTERS.get(channel['id'], 0) + 1
     save_daily_stats()
-    print(f"📈 Счетчик постов: {DAILY_POST_COUNTER}/{MAX_DAILY_POSTS}")
+    log.info(f"Счетчик постов {channel['id']}: {get_daily_post_count(channel)}/{channel['max_daily_posts']}")
 
 # --- Функции для работы с московским временем ---
 def get_moscow_time():
     """Получение текущего времени в Москве (UTC+3)"""
-    utc_now = datetime.now(timezone.utc)
+    utc_now = clock.now()
     moscow_offset = timezone(timedelta(hours=3))
     moscow_time = utc_now.astimezone(moscow_offset)
     return moscow_time
 
-def is_posting_time():
-    """Проверка можно ли постить в текущее время (по Москве) - ИСПРАВЛЕННАЯ ВЕРСИЯ"""
+def is_posting_time(channel=None):
+    """Проверка можно ли постить в текущее время (по Москве) с учетом окна канала"""
     try:
         # Получаем текущее время в Москве
         moscow_time = get_moscow_time()
+        current_minutes = moscow_time.hour * 60 + moscow_time.minute
         
-        current_hour = moscow_time.hour
-        current_minute = moscow_time.minute
-        
-        # ЗАПРЕЩЕНО: с 23:50 до 07:00 (включительно)
-        # РАЗРЕШЕНО: с 07:00 до 23:50
-        
-        # Если время между 23:50 и 23:59 - запрещено
-        if current_hour == 23 and current_minute >= 50:
-            return False
-        
-        # Если время между 00:00 и 06:59 - запрещено
-        if 0 <= current_hour < 7:
-            return False
+        # По умолчанию РАЗРЕШЕНО: с 07:00 до 23:50, ЗАПРЕЩЕНО: с 23:50 до 07:00
+        start_minutes, end_minutes = (channel or PRIMARY_CHANNEL)['window_minutes']
         
-        # Если время ровно 07:00 - разрешено
-        if current_hour == 7 and current_minute == 0:
-            return True
+        if start_minutes <= end_minutes:
+            return start_minutes <= current_minutes < end_minutes
         
-        # Все остальное время с 07:01 до 23:49 - разрешено
-        if 7 <= current_hour <= 23:
-            return True
-            
-        return False
+        # Окно через полночь, например "22:00-02:00"
+        return current_minutes >= start_minutes or current_minutes < end_minutes
             
     except Exception as e:
-        print(f"🕒 Критическая ошибка определения времени: {e}")
-        print("💡 Разрешаю постинг для надежности работы")
+        log.error(f"Критическая ошибка определения времени, разрешаю постинг для надежности: {e}")
         # В случае ошибки разрешаем постинг чтобы бот не остановился
         return True
 
-posted_news = load_posted_news()
-load_daily_stats()
+# --- Каналы публикации ---
+def parse_posting_window(value):
+    """Разбор окна постинга вида "07:00-23:50" в минуты от начала суток"""
+    start, end = value.split('-')
+    start_hour, start_minute = map(int, start.strip().split(':'))
+    end_hour, end_minute = map(int, end.strip().split(':'))
+    return start_hour * 60 + start_minute, end_hour * 60 + end_minute
+
+def normalize_channel(config):
+    """Приведение описания канала к единому виду"""
+    if isinstance(config, str):
+        config = {'id': config}
+    
+    posting_window = config.get('posting_window', DEFAULT_POSTING_WINDOW)
+    return {
+        'id': config['id'],
+        'sources': config.get('sources') or None,  # подстроки URL источников
+        'regions': config.get('regions') or None,  # 'federal' и/или 'spb'
+        'max_daily_posts': int(config.get('max_daily_posts', MAX_DAILY_POSTS)),
+        'posting_window': posting_window,
+        'window_minutes': parse_posting_window(posting_window)
+    }
+
+def load_channels():
+    """Загрузка списка каналов: CHANNELS (JSON) → channels.json → CHANNEL_ID"""
+    try:
+        config = None
+        channels_json = os.getenv("CHANNELS", "")
+        if channels_json:
+            config = json.loads(channels_json)
+        elif os.path.exists(CHANNELS_FILE):
+            with open(CHANNELS_FILE, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+        
+        if config:
+            return [normalize_channel(channel) for channel in config]
+    except Exception as e:
+        log.warning(f"Ошибка загрузки конфигурации каналов: {e}")
+    
+    return [normalize_channel({'id': CHANNEL_ID})]
+
+# До загрузки состояния - один канал из CHANNEL_ID (без чтения файлов)
+CHANNELS = [normalize_channel({'id': CHANNEL_ID})]
+PRIMARY_CHANNEL = CHANNELS[0]
+
+def configure_channels():
+    """Загрузка конфигурации каналов при запуске"""
+    global CHANNELS, PRIMARY_CHANNEL
+    CHANNELS = load_channels()
+    PRIMARY_CHANNEL = CHANNELS[0]
+
+def is_primary_channel(channel):
+    """Основной канал - первый в списке; его счетчик и posted.json совместимы со старым форматом"""
+    return channel is None or channel['id'] == PRIMARY_CHANNEL['id']
+
+def channel_accepts_source(channel, source_url):
+    """Проверка, подходит ли источник под фильтры канала"""
+    if channel['sources'] and not any(source in source_url for source in channel['sources']):
+        return False
+    if channel['regions'] and get_source_region(source_url) not in channel['regions']:
+        return False
+    return True
+
+def posted_key(channel, news_id):
+    """Ключ новости в posted_news для конкретного канала"""
+    if is_primary_channel(channel):
+        return news_id
+    return f"{channel['id']}|{news_id}"
+
+# --- Планировщик публикаций ---
+LAST_QUEUE_DEPTH = None  # сколько новых кандидатов нашла последняя публикация
+
+def seconds_of_day(moscow_time):
+    """Секунды от начала суток по Москве"""
+    return moscow_time.hour * 3600 + moscow_time.minute * 60 + moscow_time.second + moscow_time.microsecond / 1e6
+
+def seconds_until(target_minutes, moscow_time):
+    """Секунды до ближайшего наступления времени суток (в минутах от полуночи)"""
+    return (target_minutes * 60 - seconds_of_day(moscow_time)) % 86400
+
+def plan_next_publish(channel, queue_depth=None):
+    """Секунды до следующего слота канала: окно постинга, остаток лимита и глубина очереди"""
+    moscow_time = get_moscow_time()
+    start_minutes, end_minutes = channel['window_minutes']
+    remaining = channel['max_daily_posts'] - get_daily_post_count(channel)
+    
+    # Вне окна или лимит исчерпан - просыпаемся ровно к открытию окна
+    if not is_posting_time(channel) or remaining <= 0:
+        return seconds_until(start_minutes, moscow_time) + 1
+    
+    # Новых новостей не было - лимит не потрачен, проверяем снова как можно раньше
+    if queue_depth == 0:
+        return PUBLISH_MIN_INTERVAL
+    
+    # Равномерно распределяем остаток лимита до закрытия окна (последний слот - до закрытия)
+    window_left = seconds_until(end_minutes, moscow_time)
+    interval = window_left / (remaining + 1)
+    return max(PUBLISH_MIN_INTERVAL, min(PUBLISH_MAX_INTERVAL, interval))
+
+def plan_posts_per_slot(channel):
+    """Сколько новостей публиковать в слоте, чтобы успеть выбрать лимит до закрытия окна"""
+    remaining = channel['max_daily_posts'] - get_daily_post_count(channel)
+    if remaining <= 0 or not is_posting_time(channel):
+        return 0
+    
+    window_left = max(1, seconds_until(channel['window_minutes'][1], get_moscow_time()))
+    needed = math.ceil(remaining * PUBLISH_MIN_INTERVAL / window_left)
+    return max(1, min(remaining, needed, PUBLISH_MAX_PER_SLOT))
+
+def get_active_channels(channels=None):
+    """Каналы, в которые сейчас можно публиковать (окно постинга и дневной лимит)"""
+    return [channel for channel in (channels or CHANNELS)
+            if is_posting_time(channel) and can_post_more_today(channel)]
+
+# Состояние загружается в load_state() при запуске, а не при импорте
+posted_news = set()
+
+def load_state():
+    """Загрузка каналов, опубликованных новостей, дневной статистики и кэшей прошлого запуска"""
+    global posted_news
+    configure_channels()
+    posted_news = load_posted_news()
+    load_daily_stats()
+    load_warm_snapshot()
+
+# --- Общее хранилище (SQLite): аренда лидера и кандидаты от воркеров ---
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+PUBLISHER_LEASE = 'publisher'
+IS_LEADER = False
+state_db = None
+
+class LeadershipLost(Exception):
+    """Аренду лидера перехватил другой процесс"""
+
+def get_state_db():
+    """Подключение к общему хранилищу (создает таблицы при первом обращении)"""
+    global state_db
+    if state_db is None:
+        state_db = sqlite3.connect(STATE_DB_PATH, timeout=10, isolation_level=None)
+        state_db.execute('PRAGMA journal_mode=WAL')
+        state_db.execute('CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT, expires_at REAL)')
+        state_db.execute('CREATE TABLE IF NOT EXISTS candidates (link TEXT PRIMARY KEY, source TEXT, payload TEXT, fetched_at REAL)')
+        state_db.execute('CREATE TABLE IF NOT EXISTS source_fetches (source TEXT PRIMARY KEY, fetched_at REAL)')
+        state_db.execute('CREATE TABLE IF NOT EXISTS posted (key TEXT PRIMARY KEY, posted_at REAL)')
+        state_db.execute('CREATE TABLE IF NOT EXISTS source_watermarks (source TEXT PRIMARY KEY, published TEXT, links TEXT)')
+        state_db.execute('CREATE TABLE IF NOT EXISTS posted_filter (generation INTEGER PRIMARY KEY, started_at REAL, capacity INTEGER, bits BLOB, last_rowid INTEGER)')
+        if 'last_rowid' not in {column[1] for column in state_db.execute('PRAGMA table_info(posted_filter)')}:
+            state_db.execute('ALTER TABLE posted_filter ADD COLUMN last_rowid INTEGER')
+        state_db.execute('CREATE TABLE IF NOT EXISTS warm_snapshot (name TEXT PRIMARY KEY, saved_at REAL, payload TEXT)')
+        state_db.execute('CREATE TABLE IF NOT EXISTS source_schedule (source TEXT PRIMARY KEY, interval REAL, rate REAL, polled_at REAL, next_poll REAL)')
+    return state_db
+
+def try_acquire_lease(name=PUBLISHER_LEASE, ttl=None):
+    """Захват или продление аренды: True - мы лидер, False - лидер другой, None - ошибка хранилища"""
+    ttl = ttl or LEASE_TTL
+    try:
+        db = get_state_db()
+        now = time.time()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute('SELECT owner, expires_at FROM leases WHERE name = ?', (name,)).fetchone()
+            if row is None or row[0] == INSTANCE_ID or row[1] < now:
+                db.execute('INSERT OR REPLACE INTO leases (name, owner, expires_at) VALUES (?, ?, ?)',
+                           (name, INSTANCE_ID, now + ttl))
+                acquired = True
+            else:
+                acquired = False
+            db.execute('COMMIT')
+            return acquired
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+    except sqlite3.Error as e:
+        log.warning(f"Ошибка аренды лидера: {e}")
+        return None
+
+def release_lease(name=PUBLISHER_LEASE):
+    """Освобождение аренды при остановке, чтобы резервный процесс сразу стал лидером"""
+    try:
+        get_state_db().execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, INSTANCE_ID))
+    except sqlite3.Error as e:
+        log.warning(f"Ошибка освобождения аренды: {e}")
+
+async def wait_for_leadership():
+    """Ожидание аренды лидера: публикует и опрашивает Telegram только один процесс"""
+    global IS_LEADER
+    while not try_acquire_lease():
+        log.info(f"Лидер уже работает, повторная попытка через {LEASE_TTL // 3} секунд...")
+        await asyncio.sleep(LEASE_TTL // 3)
+    IS_LEADER = True
+    log.info(f"Процесс {INSTANCE_ID} стал лидером")
+
+async def lease_keeper():
+    """Фоновое продление аренды лидера"""
+    global IS_LEADER
+    while True:
+        await asyncio.sleep(LEASE_TTL // 3)
+        if try_acquire_lease() is False:
+            IS_LEADER = False
+            raise LeadershipLost("аренду перехватил другой процесс")
+
+def store_candidates(source_url, items, mark_fetched=True, seen=None):
+    """Пополнение пула кандидатов: новые записи источника ждут публикации до FRESHNESS_WINDOW_HOURS
+    
+    Водяной знак источника сдвигается в той же транзакции, так что сбой до сохранения записей их не теряет.
+    seen - все обработанные записи ленты (по умолчанию items; воркер сохраняет не все, но видел все)
+    mark_fetched - отметить источник как обработанный (так воркер сообщает, что публикатору его запрашивать не нужно)"""
+    db = get_state_db()
+    now = clock.now().timestamp()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        db.execute('DELETE FROM candidates WHERE fetched_at < ?', (now - FRESHNESS_WINDOW_HOURS * 3600,))
+        db.executemany(
+            'INSERT OR REPLACE INTO candidates (link, source, payload, fetched_at) VALUES (?, ?, ?, ?)',
+            [(item.link, source_url, json.dumps(item.to_dict(), ensure_ascii=False), now) for item in items]
+        )
+        advance_watermark(db, source_url, items if seen is None else seen)
+        if mark_fetched:
+            db.execute('INSERT OR REPLACE INTO source_fetches (source, fetched_at) VALUES (?, ?)', (source_url, now))
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+
+def fresh_worker_sources(sources, max_age=None):
+    """Источники, которые воркеры обработали недавно (не старше двух интервалов опроса источника)"""
+    try:
+        now = clock.now().timestamp()
+        fetched_at = dict(get_state_db().execute('SELECT source, fetched_at FROM source_fetches'))
+        schedule = get_source_schedule()
+    except sqlite3.Error as e:
+        log.warning(f"Ошибка чтения кандидатов воркеров: {e}")
+        return set()
+    return {source for source in sources
+            if source in fetched_at
+            and fetched_at[source] >= now - (max_age or source_poll_interval(source, schedule) * 2)}
+
+def load_candidates(sources):
+    """Пул кандидатов источников: новые и еще не опубликованные записи прошлых циклов"""
+    wanted = set(sources)
+    items = []
+    for source, payload in get_state_db().execute('SELECT source, payload FROM candidates ORDER BY fetched_at'):
+        if source not in wanted:
+            continue
+        item = NewsItem.from_dict(json.loads(payload))
+        # Текст статьи воркер уже извлек - кладем в общий кэш
+        if item.text:
+            cache_put(ARTICLE_TEXT_CACHE, item.link, item.text)
+            item.text = None
+        items.append(item)
+    return items
+
+def discard_candidate(link):
+    """Удаление отклоненной новости из пула: иначе ее статья загружалась бы и отклонялась в каждом слоте"""
+    try:
+        get_state_db().execute('DELETE FROM candidates WHERE link = ?', (link,))
+    except sqlite3.Error as e:
+        log.warning(f"Ошибка удаления кандидата: {e}")
+
+# --- Водяные знаки источников: в конвейер попадают только новые записи лент ---
+WATERMARK_LINKS = 200  # сколько последних ссылок источника помнить
+WATERMARK_TOLERANCE = timedelta(hours=6)  # насколько запись может опоздать относительно знака
+
+def read_watermark(db, source_url):
+    """Водяной знак источника: (самая поздняя дата публикации, последние виденные ссылки)"""
+    row = db.execute('SELECT published, links FROM source_watermarks WHERE source = ?', (source_url,)).fetchone()
+    watermark = datetime.fromisoformat(row[0]) if row and row[0] else None
+    return watermark, json.loads(row[1]) if row else []
+
+def filter_new_items(source_url, items):
+    """Записи ленты, которых источник еще не отдавал (знак сдвигает store_candidates после сохранения)
+    
+    Повторы отсекает список ссылок; дата отсекает только записи старше знака с допуском и лишь когда
+    список уже переполнен - иначе опоздавшие и задним числом датированные записи терялись бы"""
+    watermark, seen_links = read_watermark(get_state_db(), source_url)
+    seen = set(seen_links)
+    cutoff = watermark - WATERMARK_TOLERANCE if watermark and len(seen_links) >= WATERMARK_LINKS else None
+    
+    new_items = []
+    for item in items:
+        if item.link in seen:
+            continue
+        if cutoff and item.published and datetime.fromisoformat(item.published) < cutoff:
+            continue
+        new_items.append(item)
+    return new_items
+
+def advance_watermark(db, source_url, items):
+    """Сдвиг водяного знака на обработанные записи (в транзакции вызывающего; повторный вызов безвреден)"""
+    watermark, seen_links = read_watermark(db, source_url)
+    seen = set(seen_links)
+    new_links = list(dict.fromkeys(item.link for item in items if item.link and item.link not in seen))
+    dates = [datetime.fromisoformat(item.published) for item in items if item.published]
+    if watermark:
+        dates.append(watermark)
+    db.execute('INSERT OR REPLACE INTO source_watermarks (source, published, links) VALUES (?, ?, ?)',
+               (source_url, max(dates).isoformat() if dates else None,
+                json.dumps((new_links + seen_links)[:WATERMARK_LINKS])))
+
+# --- Адаптивный опрос источников: интервал подстраивается под частоту новых записей ---
+POLL_TARGET_ITEMS = 1      # сколько новых записей в среднем ждем от одного опроса
+POLL_RATE_SMOOTHING = 0.3  # вес последнего опроса в сглаженной частоте
+POLL_JITTER = 0.15         # разброс момента опроса, чтобы источники не опрашивались одной пачкой
+
+def get_source_schedule():
+    """Расписание опроса: источник -> (интервал, частота записей в секунду, время опроса, следующий опрос)"""
+    return {row[0]: row[1:] for row in get_state_db().execute(
+        'SELECT source, interval, rate, polled_at, next_poll FROM source_schedule')}
+
+def source_poll_interval(source_url, schedule=None):
+    """Текущий интервал опроса источника (до первых наблюдений - из реестра)"""
+    schedule = get_source_schedule() if schedule is None else schedule
+    if source_url in schedule:
+        return schedule[source_url][0]
+    return get_source_config(source_url)['poll_interval']
+
+def due_sources(sources, now=None):
+    """Источники, которым пора опрашиваться (еще не опрошенные - сразу)"""
+    now = now or clock.now().timestamp()
+    schedule = get_source_schedule()
+    return [source for source in sources if source not in schedule or schedule[source][3] <= now]
+
+def record_source_poll(source_url, new_count, now=None):
+    """Учет опроса: сглаженная частота новых записей задает следующий интервал (с разбросом)
+    
+    new_count=None - опрос не удался: частота, интервал и время удачного опроса не меняются, повтор -
+    через время, прошедшее с удачного опроса (не раньше SOURCE_POLL_MIN и не позже обычного интервала)"""
+    now = now or clock.now().timestamp()
+    db = get_state_db()
+    row = db.execute('SELECT interval, rate, polled_at FROM source_schedule WHERE source = ?', (source_url,)).fetchone()
+    if new_count is None:
+        interval, rate, polled_at = row or (get_source_config(source_url)['poll_interval'], None, None)
+        delay = min(max(now - (polled_at or now), SOURCE_POLL_MIN), interval)
+        db.execute('INSERT OR REPLACE INTO source_schedule (source, interval, rate, polled_at, next_poll) VALUES (?, ?, ?, ?, ?)',
+                   (source_url, interval, rate, polled_at, now + delay * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)))
+        return delay
+    if row and row[2] is not None:
+        _, rate, polled_at = row
+        observed = new_count / max(now - polled_at, 1)
+        rate = observed if rate is None else POLL_RATE_SMOOTHING * observed + (1 - POLL_RATE_SMOOTHING) * rate
+        interval = POLL_TARGET_ITEMS / rate if rate > 0 else SOURCE_POLL_MAX
+    else:
+        # Первый опрос отдает всю ленту - частоту по нему не оцениваем
+        rate = None
+        interval = get_source_config(source_url)['poll_interval']
+    interval = min(max(interval, SOURCE_POLL_MIN), SOURCE_POLL_MAX)
+    next_poll = now + interval * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+    db.execute('INSERT OR REPLACE INTO source_schedule (source, interval, rate, polled_at, next_poll) VALUES (?, ?, ?, ?, ?)',
+               (source_url, interval, rate, now, next_poll))
+    return interval
+
+# --- Теплый перезапуск: кэши переживают остановку процесса ---
+# Пул кандидатов, водяные знаки и расписание опроса уже лежат в общем хранилище;
+# в снимок попадают кэши в памяти, без которых первая публикация снова пошла бы в сеть
+WARM_SNAPSHOT_MAX_AGE = 30 * 86400  # file_id Telegram и кодировки доменов меняются редко
+
+def warm_caches():
+    """Кэши снимка: имя -> (кэш, допустимый возраст снимка в секундах)"""
+    return {
+        # Тексты нужны только для новостей, которые еще могут выйти
+        'article_texts': (ARTICLE_TEXT_CACHE, FRESHNESS_WINDOW_HOURS * 3600),
+        'image_file_ids': (IMAGE_FILE_IDS, WARM_SNAPSHOT_MAX_AGE),
+        'source_charsets': (SOURCE_CHARSETS, WARM_SNAPSHOT_MAX_AGE)
+    }
+
+def save_warm_snapshot():
+    """Снимок кэшей при остановке: тексты статей из пула кандидатов, file_id картинок, кодировки доменов"""
+    if DRY_RUN:
+        return
+    try:
+        db = get_state_db()
+        pooled = {link for (link,) in db.execute('SELECT link FROM candidates')}
+        now = time.time()
+        entries = {
+            'article_texts': {link: text for link, text in ARTICLE_TEXT_CACHE.items() if link in pooled},
+            # Заглушку могли заменить при деплое - ее file_id не переносим
+            'image_file_ids': {key: file_id for key, file_id in IMAGE_FILE_IDS.items() if key != DEFAULT_PLACEHOLDER_PATH},
+            'source_charsets': SOURCE_CHARSETS
+        }
+        db.executemany('INSERT OR REPLACE INTO warm_snapshot (name, saved_at, payload) VALUES (?, ?, ?)',
+                       [(name, now, json.dumps(cache, ensure_ascii=False)) for name, cache in entries.items()])
+        log.info("Снимок кэшей сохранен", extra={'fields': {name: len(cache) for name, cache in entries.items()}})
+    except (sqlite3.Error, TypeError, ValueError) as e:
+        log.warning(f"Ошибка сохранения снимка кэшей: {e}")
+
+def load_warm_snapshot():
+    """Восстановление кэшей из снимка прошлого запуска (устаревшие части и тексты вне пула пропускаются)"""
+    try:
+        db = get_state_db()
+        rows = db.execute('SELECT name, saved_at, payload FROM warm_snapshot').fetchall()
+        pooled = {link for (link,) in db.execute('SELECT link FROM candidates')}
+    except sqlite3.Error as e:
+        log.warning(f"Ошибка чтения снимка кэшей: {e}")
+        return
+    
+    caches = warm_caches()
+    now = time.time()
+    restored = {}
+    for name, saved_at, payload in rows:
+        if name not in caches:
+            continue
+        cache, max_age = caches[name]
+        if now - saved_at > max_age:
+            log.info(f"Снимок {name} устарел ({int((now - saved_at) // 3600)} ч) - пропускаем")
+            continue
+        try:
+            entries = json.loads(payload)
+        except ValueError as e:
+            log.warning(f"Поврежден снимок {name}: {e}")
+            continue
+        if name == 'article_texts':
+            entries = {link: text for link, text in entries.items() if link in pooled}
+        for key, value in entries.items():
+            if isinstance(cache, OrderedDict):
+                cache_put(cache, key, value)
+            else:
+                cache.setdefault(key, value)
+        restored[name] = len(entries)
+    
+    if restored:
+        log.info(f"Теплый перезапуск: восстановлено {sum(restored.values())} записей кэшей",
+                 extra={'fields': restored})
+
+def save_state_on_exit():
+    """Сохранение состояния при остановке (пишет только лидер, чтобы не затереть его данные)"""
+    if IS_LEADER:
+        save_posted_news(posted_news)
+        save_daily_stats()
+        save_warm_snapshot()
+        release_lease()
 
 # --- Обработчик остановки ---
 def signal_handler(signum, frame):
-    print(f"🔻 Получен сигнал {signum}, сохраняем данные...")
-    save_posted_news(posted_news)
-    save_daily_stats()
-    if instance_socket:
-        instance_socket.close()
+    log.info(f"Получен сигнал {signum}, сохраняем данные...")
+    save_state_on_exit()
     sys.exit(0)
 
-signal.signal(signal.SIGINT, signal_handler)
-signal.signal(signal.SIGTERM, signal_handler)
+def install_signal_handlers():
+    """Сохранение состояния по SIGINT/SIGTERM"""
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+
+# --- Диагностика памяти: RSS, открытые файлы, временные картинки, места выделения памяти ---
+MEMORY_SAMPLE_INTERVAL = 300
+MEMORY_HISTORY = deque(maxlen=288)  # замеры раз в 5 минут за последние сутки
+
+def process_rss_mb():
+    """Резидентная память процесса в МБ (/proc, иначе пиковая по getrusage)"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def open_file_count():
+    """Число открытых дескрипторов процесса (None, если /proc недоступен)"""
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+def temp_image_usage():
+    """Временные картинки в рабочей папке: количество и общий размер в КБ"""
+    count = size = 0
+    for entry in os.scandir('.'):
+        if entry.name.startswith('temp_image_'):
+            try:
+                size += entry.stat().st_size
+                count += 1
+            except OSError:
+                pass
+    return count, round(size / 1024, 1)
+
+def memory_sample():
+    """Замер процесса: память, дескрипторы, временные файлы и размеры хранилищ"""
+    import tracemalloc
+    temp_images, temp_images_kb = temp_image_usage()
+    sample = {
+        'at': clock.now().isoformat(),
+        'rss_mb': process_rss_mb(),
+        'open_files': open_file_count(),
+        'temp_images': temp_images,
+        'temp_images_kb': temp_images_kb,
+        'article_texts': len(ARTICLE_TEXT_CACHE),
+        'image_file_ids': len(IMAGE_FILE_IDS),
+        'posted': len(posted_news)
+    }
+    if tracemalloc.is_tracing():
+        sample['traced_mb'] = round(tracemalloc.get_traced_memory()[0] / 1024 / 1024, 2)
+    return sample
+
+def memory_report(limit=10):
+    """Отчет /admin/memory: текущий замер, история и крупнейшие места выделения памяти (при трассировке)"""
+    import tracemalloc
+    report = {'current': memory_sample(), 'history': list(MEMORY_HISTORY), 'tracing': tracemalloc.is_tracing()}
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>')
+        ))
+        report['traced_peak_mb'] = round(peak / 1024 / 1024, 2)
+        report['top'] = [{'where': str(stat.traceback[0]), 'size_kb': round(stat.size / 1024, 1), 'blocks': stat.count}
+                         for stat in snapshot.statistics('lineno')[:limit]]
+    return report
+
+async def memory_monitor():
+    """Фоновые замеры памяти для истории /admin/memory"""
+    while True:
+        try:
+            MEMORY_HISTORY.append(memory_sample())
+        except Exception as e:
+            log.warning(f"Ошибка замера памяти: {e}")
+        await asyncio.sleep(MEMORY_SAMPLE_INTERVAL)
+
+# --- Здоровье конвейера: пульс цикла событий, последние загрузка и публикация ---
+HEARTBEAT_INTERVAL = 10
+KEEPALIVE_IDLE = 600  # Render усыпляет сервис после ~15 минут без входящих запросов
+HEALTH = {
+    'heartbeat': None,     # последний такт цикла событий
+    'loop_lag_ms': None,   # опоздание такта: признак блокирующих вызовов в цикле событий
+    'last_fetch': None,    # последняя успешная загрузка ленты
+    'last_publish': None,  # последняя успешная публикация
+    'last_request': None,  # последний входящий HTTP-запрос (по нему решается, нужен ли внешний пинг)
+    'last_ping': None      # последний успешный внешний пинг
+}
+health_snapshot = None  # готовый JSON для /health, обновляется пульсом
+
+def mark_health(event):
+    """Отметка события конвейера (время UNIX)"""
+    HEALTH[event] = time.time()
+
+def refresh_health_snapshot():
+    """Сборка ответа /health: обработчик только отдает готовый текст, без обращений к хранилищу"""
+    global health_snapshot
+    def moment(event):
+        return datetime.fromtimestamp(HEALTH[event], timezone.utc).isoformat() if HEALTH[event] else None
+    
+    now = time.time()
+    stale = []
+    if IS_LEADER and HEALTH['last_fetch'] and now - HEALTH['last_fetch'] > 2 * SOURCE_POLL_MAX:
+        stale.append('fetch')
+    health_snapshot = json.dumps({
+        "status": "🟢 Бот работает" if not stale else "🟡 Конвейер простаивает",
+        "leader": IS_LEADER,
+        "sources": len(NEWS_SOURCES),
+        "posted_total": len(posted_news),
+        "posted_today": DAILY_POST_COUNTER,
+        "channels": len(CHANNELS),
+        "max_daily": MAX_DAILY_POSTS,
+        "queue_depth": LAST_QUEUE_DEPTH,
+        "heartbeat": moment('heartbeat'),
+        "loop_lag_ms": HEALTH['loop_lag_ms'],
+        "last_fetch": moment('last_fetch'),
+        "last_publish": moment('last_publish'),
+        "last_ping": moment('last_ping'),
+        "stale": stale,
+        "startup": STARTUP_TIMINGS,
+        "timestamp": datetime.fromtimestamp(now, timezone.utc).isoformat(),
+        "version": "7.7 с улучшенной очисткой текста"
+    }, ensure_ascii=False)
+    return health_snapshot
+
+async def heartbeat():
+    """Пульс цикла событий: замер опоздания такта и обновление снимка /health"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        HEALTH['loop_lag_ms'] = round((time.perf_counter() - started - HEARTBEAT_INTERVAL) * 1000, 1)
+        mark_health('heartbeat')
+        try:
+            refresh_health_snapshot()
+        except Exception as e:
+            log.warning(f"Ошибка обновления состояния: {e}")
 
 # --- HTTP сервер для здоровья ---
-async def health_server():
-    """HTTP сервер для проверки здоровья"""
+WEBHOOK_TASKS = set()
+
+def create_web_app():
+    """Приложение HTTP сервера: здоровье и (в режиме webhook) прием обновлений Telegram"""
     from aiohttp import web
     
+    @web.middleware
+    async def track_requests(request, handler):
+        # Любой входящий запрос (пинг мониторинга, webhook Telegram) будит сервис не хуже собственного пинга
+        mark_health('last_request')
+        return await handler(request)
+    
     async def health_check(request):
-        return web.Response(
-            text=json.dumps({
-                "status": "🟢 Бот работает",
-                "sources": len(NEWS_SOURCES),
-                "posted_total": len(posted_news),
-                "posted_today": DAILY_POST_COUNTER,
-                "max_daily": MAX_DAILY_POSTS,
-                "timestamp": datetime.now(timezone.utc).isoformat(),
-                "version": "7.7 с улучшенной очисткой текста"
-            }, ensure_ascii=False),
-            content_type='application/json'
-        )
+        return web.Response(text=health_snapshot or refresh_health_snapshot(), content_type='application/json')
+    
+    async def telegram_webhook(request):
+        if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        # Резервный процесс не обрабатывает обновления - Telegram повторит доставку
+        if not IS_LEADER:
+            return web.Response(status=503)
+        
+        try:
+            from telebot import types
+            update = types.Update.de_json(await request.json())
+        except Exception as e:
+            log.warning(f"Некорректное обновление webhook: {e}")
+            return web.Response(status=400)
+        
+        # Отвечаем Telegram сразу, команда обрабатывается в фоне
+        task = asyncio.create_task(bot.process_new_updates([update]))
+        WEBHOOK_TASKS.add(task)
+        task.add_done_callback(WEBHOOK_TASKS.discard)
+        return web.Response(text='ok')
+    
+    async def admin_memory(request):
+        token = request.headers.get('X-Admin-Token') or request.query.get('token')
+        if not ADMIN_TOKEN or token != ADMIN_TOKEN:
+            return web.Response(status=403)
+        
+        import tracemalloc
+        trace = request.query.get('trace')
+        if trace == 'start' and not tracemalloc.is_tracing():
+            tracemalloc.start(MEMORY_TRACE_FRAMES or 1)
+            log.info("Трассировка памяти включена")
+        elif trace == 'stop' and tracemalloc.is_tracing():
+            tracemalloc.stop()
+            log.info("Трассировка памяти выключена")
+        
+        try:
+            limit = int(request.query.get('limit', 10))
+        except ValueError:
+            return web.Response(status=400)
+        return web.Response(text=json.dumps(memory_report(limit), ensure_ascii=False),
+                            content_type='application/json')
     
-    app = web.Application()
+    app = web.Application(middlewares=[track_requests])
     app.router.add_get('/health', health_check)
     app.router.add_get('/', health_check)
+    app.router.add_get('/admin/memory', admin_memory)
+    if TELEGRAM_MODE == 'webhook':
+        app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    
+    return app
+
+async def health_server():
+    """HTTP сервер для проверки здоровья"""
+    from aiohttp import web
     
+    app = create_web_app()
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, '0.0.0.0', PORT)
     await site.start()
-    print(f"🌐 HTTP сервер запущен на порту {PORT}")
+    log.info(f"HTTP сервер запущен на порту {PORT}")
     
     return runner
 
 # --- Keep-Alive для Render ---
 async def enhanced_keep_alive():
-    """Улучшенный keep-alive без случайных публикаций"""
-    print("🔄 ЗАПУСК УЛУЧШЕННОГО KEEP-ALIVE...")
+    """Keep-alive для Render: внешний пинг через общую сессию и только после простоя без входящих запросов
+    
+    Живость самого процесса отслеживает пульс (heartbeat), внутренний пинг по localhost не нужен"""
+    if not RENDER_APP_URL:
+        log.info("RENDER_APP_URL не задан - внешний keep-alive не нужен")
+        return
+    log.info("Запуск keep-alive")
     
     while True:
-        try:
-            # Внутренний пинг
+        idle = time.time() - (HEALTH['last_request'] or 0)
+        if idle >= KEEPALIVE_IDLE:
+            new_cycle_id('keepalive')
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(f'http://localhost:{PORT}/health', timeout=10) as resp:
-                        if resp.status == 200:
-                            moscow_time = get_moscow_time()
-                            print(f"✅ Внутренний ping: {moscow_time.strftime('%H:%M:%S')}")
+                async with get_http_session().get(f'{RENDER_APP_URL}/health',
+                                                  params={'ping': random.randint(1000, 9999)},
+                                                  timeout=aiohttp.ClientTimeout(total=30)) as resp:
+                    await resp.read()
+                    if resp.status == 200:
+                        mark_health('last_ping')
+                        log.debug("Внешний ping успешен: %s", get_moscow_time().strftime('%H:%M:%S'))
+                    else:
+                        log.warning(f"Внешний ping: статус {resp.status}")
             except Exception as e:
-                print(f"⚠️ Ошибка внутреннего ping: {e}")
-            
-            # Внешний PING
-            if RENDER_APP_URL:
-                try:
-                    async with aiohttp.ClientSession() as session:
-                        random_param = f"?ping={random.randint(1000,9999)}"
-                        async with session.get(f'{RENDER_APP_URL}/health{random_param}', timeout=30) as resp:
-                            if resp.status == 200:
-                                moscow_time = get_moscow_time()
-                                print(f"🌐 ВНЕШНИЙ PING УСПЕШЕН: {moscow_time.strftime('%H:%M:%S')}")
-                except Exception as e:
-                    print(f"⚠️ Ошибка внешнего ping: {e}")
-            
-        except Exception as e:
-            print(f"⚠️ Общая ошибка keep-alive: {e}")
+                log.warning(f"Ошибка внешнего ping: {e}")
+            idle = 0
         
-        sleep_time = random.randint(480, 600)  # 8-10 минут
-        print(f"💤 Следующий keep-alive через {sleep_time} секунд...")
+        # Следующая проверка - когда простой дойдет до порога (с разбросом до минуты)
+        sleep_time = max(KEEPALIVE_IDLE - idle, 30) + random.randint(0, 60)
+        log.debug("Следующая проверка keep-alive через %d секунд", sleep_time)
         await asyncio.sleep(sleep_time)
 
 # --- УЛУЧШЕННЫЙ ПАРСИНГ И ОЧИСТКА ТЕКСТА ---
@@ -329,10 +1248,96 @@ def clean_whitespace(text):
     
     return text.strip()
 
-def extract_complete_text_from_html(html_content, title):
+# --- Фильтр служебных абзацев ---
+BOILERPLATE_MARKERS = [
+    '©', 'Фото:', 'Источник:', 'Читайте также:', 'Редакция',
+    'Комментарии', 'Подпишитесь', 'Rambler', 'ТАСС',
+    'Lenta.ru', 'РИА Новости', 'Поделиться', 'Следите за',
+    'INTERFAX.RU', 'https://', 'http://', 'www.'
+]
+# Дополнительные маркеры отдельных изданий (ключ - домен без www.)
+SOURCE_BOILERPLATE_MARKERS = {
+    'fontanka.ru': ['Фонтанка.ру', 'Сообщить новость'],
+    'kommersant.ru': ['Коммерсантъ'],
+    'interfax.ru': ['Интерфакс'],
+    'dp.ru': ['Деловой Петербург'],
+    '78.ru': ['78.ру']
+}
+
+class BoilerplateFilter:
+    """Фильтр абзацев: все маркеры в одном регулярном выражении, слова заголовка считаются один раз"""
+
+    def __init__(self, markers):
+        self.pattern = re.compile('|'.join(re.escape(marker) for marker in markers))
+
+    def is_meaningful(self, text, title_words):
+        """Абзац достаточно длинный, без служебных маркеров и не повторяет заголовок"""
+        return (len(text) > 40 and
+                not text.startswith('http') and
+                self.pattern.search(text) is None and
+                len(text.split()) > 8 and
+                not is_similar_to_title_words(text, title_words))
+
+boilerplate_filters = {}
+
+def get_boilerplate_filter(url=None):
+    """Фильтр для издания по URL статьи (собирается один раз на домен)"""
+    domain = urlparse(url).netloc.lower() if url else ''
+    if domain.startswith('www.'):
+        domain = domain[4:]
+    if domain not in SOURCE_BOILERPLATE_MARKERS:
+        domain = ''
+    
+    if domain not in boilerplate_filters:
+        markers = BOILERPLATE_MARKERS + SOURCE_BOILERPLATE_MARKERS.get(domain, [])
+        boilerplate_filters[domain] = BoilerplateFilter(markers)
+    return boilerplate_filters[domain]
+
+def get_title_words(title):
+    """Множество слов заголовка в нижнем регистре"""
+    return frozenset(title.lower().split()) if title else frozenset()
+
+def is_similar_to_title_words(text, title_words):
+    """Текст содержит более 70% слов заголовка"""
+    if not text or not title_words:
+        return False
+    text_words = set(text.lower().split())
+    common_count = sum(1 for word in title_words if word in text_words)
+    return common_count / len(title_words) > 0.7
+
+TEXT_BLOCK_TAGS = ('p', 'div', 'h2', 'h3')
+
+def iter_text_blocks(element, collect_inline=False):
+    """Обход контейнера за один проход: текст каждого абзаца материализуется один раз.
+    
+    Блок с вложенными блоками не отдается целиком - вместо него отдаются вложенные
+    блоки и собственные строки между ними.
+    """
+    bs4 = load_bs4()
+    inline_parts = []
+    for child in element.children:
+        if isinstance(child, bs4.Tag):
+            has_nested_blocks = child.find(TEXT_BLOCK_TAGS) is not None
+            if child.name in TEXT_BLOCK_TAGS or has_nested_blocks:
+                if inline_parts:
+                    yield ''.join(inline_parts).strip()
+                    inline_parts = []
+                if has_nested_blocks:
+                    yield from iter_text_blocks(child, child.name in TEXT_BLOCK_TAGS)
+                else:
+                    yield child.get_text().strip()
+            elif collect_inline:
+                inline_parts.append(child.get_text())
+        elif collect_inline and type(child) is bs4.NavigableString:
+            inline_parts.append(child)
+    
+    if inline_parts:
+        yield ''.join(inline_parts).strip()
+
+def extract_complete_text_from_html(html_content, title, url=None):
     """Извлечение полного текста новости с улучшенной очисткой"""
     try:
-        soup = BeautifulSoup(html_content, 'html.parser')
+        soup = load_bs4().BeautifulSoup(html_content, 'html.parser')
         
         # Удаляем ненужные элементы
         for element in soup(['script', 'style', 'nav', 'footer', 'aside', 'header', 'form', 'button', 'iframe']):
@@ -365,30 +1370,21 @@ def extract_complete_text_from_html(html_content, title):
         if not content_element:
             content_element = soup.find('body') or soup
         
-        # Собираем все значимые элементы текста
-        text_elements = content_element.find_all(['p', 'div', 'h2', 'h3'])
-        meaningful_paragraphs = []
+        # Маркеры издания и слова заголовка готовим один раз на статью
+        boilerplate_filter = get_boilerplate_filter(url)
+        title_words = get_title_words(title)
         
-        for element in text_elements:
-            text = element.get_text().strip()
-            # УЛУЧШЕННАЯ ФИЛЬТРАЦИЯ - удаляем текст, похожий на заголовок
-            if (len(text) > 40 and 
-                not any(x in text for x in [
-                    '©', 'Фото:', 'Источник:', 'Читайте также:', 'Редакция',
-                    'Комментарии', 'Подпишитесь', 'Rambler', 'ТАСС', 
-                    'Lenta.ru', 'РИА Новости', 'Поделиться', 'Следите за',
-                    'INTERFAX.RU', 'https://', 'http://', 'www.'
-                ]) and
-                len(text.split()) > 8 and
-                not text.startswith('http') and
-                # УДАЛЯЕМ ТЕКСТ, КОТОРЫЙ СОДЕРЖИТ ЗАГОЛОВОК
-                not is_text_similar_to_title(text, title)):
+        # Берем только 2-3 первых значимых абзаца - обход останавливается на третьем
+        meaningful_paragraphs = []
+        for text in iter_text_blocks(content_element):
+            # УЛУЧШЕННАЯ ФИЛЬТРАЦИЯ - удаляем служебный текст и текст, похожий на заголовок
+            if boilerplate_filter.is_meaningful(text, title_words):
                 meaningful_paragraphs.append(text)
+                if len(meaningful_paragraphs) == 3:
+                    break
         
-        # Берем только 2-3 первых значимых абзаца
         if meaningful_paragraphs:
-            selected_paragraphs = meaningful_paragraphs[:3]
-            full_text = '\n\n'.join(selected_paragraphs)
+            full_text = '\n\n'.join(meaningful_paragraphs)
             
             # ДОПОЛНИТЕЛЬНАЯ ОЧИСТКА от дубликатов заголовка
             full_text = remove_title_duplicates(full_text, title)
@@ -399,7 +1395,7 @@ def extract_complete_text_from_html(html_content, title):
             return full_text[:3000]
             
     except Exception as e:
-        print(f"⚠️ Ошибка парсинга HTML: {e}")
+        log.warning(f"Ошибка парсинга HTML: {e}")
     
     return ""
 
@@ -408,34 +1404,19 @@ def is_text_similar_to_title(text, title):
     if not text or not title:
         return False
     
-    # Нормализуем текст для сравнения
-    text_normalized = re.sub(r'\s+', ' ', text.lower()).strip()
-    title_normalized = re.sub(r'\s+', ' ', title.lower()).strip()
-    
     # Если текст содержит более 70% слов из заголовка - считаем дубликатом
-    title_words = set(title_normalized.split())
-    text_words = set(text_normalized.split())
-    
-    if len(title_words) == 0:
-        return False
-    
-    common_words = title_words.intersection(text_words)
-    similarity_ratio = len(common_words) / len(title_words)
-    
-    return similarity_ratio > 0.7
+    return is_similar_to_title_words(text, get_title_words(title))
 
-def remove_title_duplicates(text, title):
-    """Удаляет дубликаты заголовка из текста"""
-    if not text or not title:
-        return text
-    
+@functools.lru_cache(maxsize=256)
+def title_duplicate_patterns(title):
+    """Скомпилированные паттерны дубликатов заголовка (один заголовок проверяется на нескольких этапах)"""
     # Нормализуем заголовок для поиска
     title_normalized = re.sub(r'[^\w\s]', '', title.lower()).strip()
     title_words = title_normalized.split()
     
     # Если заголовок слишком короткий, пропускаем
     if len(title_words) < 3:
-        return text
+        return None
     
     # Создаем паттерны для поиска дубликатов
     patterns = [
@@ -449,12 +1430,23 @@ def remove_title_duplicates(text, title):
         partial_title = ' '.join(title_words[:7])
         patterns.append(re.escape(partial_title))
     
-    # Удаляем все найденные дубликаты (ИСПРАВЛЕНА ESCAPE ПОСЛЕДОВАТЕЛЬНОСТЬ)
+    # Заменяем множественные вхождения; только достаточно длинные паттерны
+    return tuple(re.compile(fr'({pattern})\s*({pattern})*', re.IGNORECASE)
+                 for pattern in patterns if len(pattern) > 20)
+
+def remove_title_duplicates(text, title):
+    """Удаляет дубликаты заголовка из текста"""
+    if not text or not title:
+        return text
+    
+    patterns = title_duplicate_patterns(title)
+    if patterns is None:
+        return text
+    
+    # Удаляем все найденные дубликаты
     cleaned_text = text
     for pattern in patterns:
-        if len(pattern) > 20:  # только достаточно длинные паттерны
-            # Заменяем множественные вхождения (ИСПРАВЛЕНО: использование raw string)
-            cleaned_text = re.sub(fr'({pattern})\s*({pattern})*', '', cleaned_text, flags=re.IGNORECASE)
+        cleaned_text = pattern.sub('', cleaned_text)
     
     return cleaned_text.strip()
 
@@ -534,10 +1526,11 @@ def create_engaging_title(original_title):
     
     return clean_title.strip()
 
-def format_news_live_piter_style(title, description, full_text):
+def format_news_live_piter_style(title, description, full_text, clean_title=None):
     """Форматирование новости в стиле Live Питер 📸 (УЛУЧШЕННАЯ ВЕРСИЯ)"""
-    # Создаем чистый заголовок
-    clean_title = create_engaging_title(title)
+    # Создаем чистый заголовок (у NewsItem он уже посчитан)
+    clean_title = clean_title or create_engaging_title(title)
+    clean_title_words = get_title_words(clean_title)
     
     # ОЧИСТКА ТЕКСТА ОТ ДУБЛИКАТОВ ЗАГОЛОВКА
     if full_text:
@@ -553,7 +1546,7 @@ def format_news_live_piter_style(title, description, full_text):
         # Фильтруем абзацы, удаляя те, что похожи на заголовок
         filtered_paragraphs = []
         for paragraph in paragraphs:
-            if not is_text_similar_to_title(paragraph, clean_title):
+            if not is_similar_to_title_words(paragraph, clean_title_words):
                 filtered_paragraphs.append(paragraph)
         
         # Берем максимум 3 абзаца после фильтрации
@@ -594,23 +1587,41 @@ def format_news_live_piter_style(title, description, full_text):
     # ОЧИСТКА ПРОБЕЛОВ - НОВАЯ ФУНКЦИЯ
     final_text = clean_whitespace(final_text)
     
-    # Обрезаем до стандартных пределов
-    if len(final_text) > 3000:
-        # Ищем естественное место для обрезки
-        cut_position = final_text.rfind('. ', 2500, 3000)
-        if cut_position == -1:
-            cut_position = final_text.rfind('! ', 2500, 3000)
-        if cut_position == -1:
-            cut_position = final_text.rfind('? ', 2500, 3000)
-        if cut_position == -1:
-            cut_position = 2997
-        
-        final_text = final_text[:cut_position + 1]
-    
-    return final_text.strip()
+    # Готовая подпись: HTML-экранирование и лимит Telegram
+    return fit_caption(final_text.strip())
+
+# --- Подпись к фото: экранирование и лимит за один проход ---
+SENTENCE_PATTERN = re.compile(r'.+?(?:[.!?…]+(?=\s|$)|$)\s*', re.DOTALL)
+
+def utf16_len(text):
+    """Длина в единицах UTF-16 - так Telegram считает длину подписи"""
+    return len(text.encode('utf-16-le')) // 2
+
+def fit_caption(text, budget=None):
+    """Подпись для parse_mode='HTML': предложения экранируются и добавляются, пока помещаются в лимит
+    
+    Лимит считается по видимому тексту (экранированный &amp; - один символ). Если не помещается
+    даже первое предложение, оно режется по границе слова с многоточием."""
+    budget = budget or CAPTION_LIMIT
+    parts = []
+    used = 0
+    for match in SENTENCE_PATTERN.finditer(text):
+        sentence = match.group(0)
+        size = utf16_len(sentence)
+        if used + size > budget:
+            if not parts:
+                cut = sentence[:budget - 1]
+                while utf16_len(cut) > budget - 1:
+                    cut = cut[:-1]
+                parts.append(html.escape(cut.rsplit(' ', 1)[0].rstrip() + '…', quote=False))
+            break
+        parts.append(html.escape(sentence, quote=False))
+        used += size
+    return ''.join(parts).strip()
 
-# --- Источники новостей ---
-NEWS_SOURCES = [
+# --- Реестр источников новостей ---
+# Встроенный список: используется, если нет SOURCES (JSON) и sources.json
+DEFAULT_NEWS_SOURCES = [
     # Общероссийские источники
     "https://lenta.ru/rss/news",
     "https://tass.ru/rss/v2.xml", 
@@ -629,6 +1640,429 @@ NEWS_SOURCES = [
     "https://www.kommersant.ru/RSS/news.xml",
 ]
 
+FEDERAL_SOURCE_MARKERS = ['lenta', 'tass', 'rambler', 'ria', 'interfax', 'kommersant']
+SOURCE_PARSERS = ('rss', 'atom')
+
+def normalize_source(source):
+    """Описание источника: строка URL или словарь url, region, priority, limit, poll_interval, parser"""
+    if isinstance(source, str):
+        source = {'url': source}
+    url = source['url']
+    parser = source.get('parser', 'rss')
+    if parser not in SOURCE_PARSERS:
+        raise ValueError(f"неизвестный профиль разбора {parser} для {url}")
+    region = source.get('region') or (
+        'federal' if any(marker in url for marker in FEDERAL_SOURCE_MARKERS) else 'spb')
+    return {
+        'url': url,
+        'region': region,
+        'priority': float(source.get('priority', 0)),
+        'limit': int(source.get('limit', 5)),
+        'poll_interval': int(source.get('poll_interval', WORKER_INTERVAL)),
+        'parser': parser
+    }
+
+def load_sources():
+    """Загрузка реестра источников: SOURCES (JSON) → sources.json → встроенный список"""
+    try:
+        config = None
+        sources_json = os.getenv("SOURCES", "")
+        if sources_json:
+            config = json.loads(sources_json)
+        elif os.path.exists(SOURCES_FILE):
+            with open(SOURCES_FILE, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+        
+        if config:
+            return [normalize_source(source) for source in config]
+    except Exception as e:
+        log.warning(f"Ошибка загрузки реестра источников: {e}")
+    
+    return [normalize_source(source) for source in DEFAULT_NEWS_SOURCES]
+
+# До загрузки конфигурации - встроенный список (без чтения файлов)
+SOURCE_REGISTRY = {source: normalize_source(source) for source in DEFAULT_NEWS_SOURCES}
+NEWS_SOURCES = list(SOURCE_REGISTRY)
+
+def configure_sources():
+    """Загрузка реестра источников при запуске"""
+    global SOURCE_REGISTRY, NEWS_SOURCES
+    SOURCE_REGISTRY = {source['url']: source for source in load_sources()}
+    NEWS_SOURCES = list(SOURCE_REGISTRY)
+
+def get_source_config(source_url):
+    """Настройки источника из реестра (для неизвестного URL - значения по умолчанию)"""
+    return SOURCE_REGISTRY.get(source_url) or normalize_source(source_url)
+
+def get_source_region(source_url):
+    """Регион источника: из реестра или 'federal' для общероссийских изданий, иначе 'spb'"""
+    return get_source_config(source_url)['region']
+
+# --- Общие кэши и HTTP-сессия (одни на все каналы) ---
+CACHE_LIMIT = 500
+ARTICLE_TEXT_CACHE = OrderedDict()  # ссылка -> извлеченный текст статьи
+IMAGE_FILE_IDS = OrderedDict()      # URL изображения или путь заглушки -> file_id в Telegram
+http_session = None
+
+# Счетчики конвейера: HTTP-запросы, подготовленные и отброшенные новости, публикации
+METRICS = Counter()
+
+def cache_put(cache, key, value, limit=CACHE_LIMIT):
+    """Добавление в ограниченный LRU-кэш"""
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > limit:
+        cache.popitem(last=False)
+
+def get_http_session():
+    """Общая HTTP-сессия с пулом соединений"""
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession()
+    return http_session
+
+async def close_http_session():
+    """Закрытие общей HTTP-сессии"""
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+# --- HTTP-слой: запись и воспроизведение трафика ---
+class HttpArchive:
+    """Архив HTTP-обменов: тела хранятся по sha256 (gzip, без дублей), индекс - JSONL
+    
+    Обрезанные загрузки (stop_at) записываются отдельно от полных: ключ - (URL, маркер)"""
+
+    def __init__(self, root):
+        self.root = root
+        self.index_path = os.path.join(root, 'index.jsonl')
+        self.entries = {}
+        self.replay_positions = {}
+        self.loaded = False
+
+    def body_path(self, digest):
+        return os.path.join(self.root, 'bodies', digest[:2], f"{digest}.gz")
+
+    def load(self):
+        """Ленивая загрузка индекса архива"""
+        if self.loaded:
+            return
+        self.loaded = True
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self.entries.setdefault((entry['url'], entry.get('stop_at')), []).append(entry)
+        log.debug("Загружен HTTP-архив: %d URL", len(self.entries))
+
+    @staticmethod
+    def marker_key(stop_at):
+        return stop_at.decode('latin-1') if stop_at else None
+
+    def record(self, url, status, content_type, body, stop_at=None):
+        """Сохранение ответа в архив (одинаковые тела хранятся один раз)"""
+        self.load()
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.body_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(gzip.compress(body, mtime=0))
+            os.replace(tmp_path, path)
+        
+        entry = {
+            'url': url,
+            'status': status,
+            'content_type': content_type,
+            'sha256': digest,
+            'size': len(body),
+            'recorded_at': datetime.now(timezone.utc).isoformat()
+        }
+        if stop_at:
+            entry['stop_at'] = self.marker_key(stop_at)
+        with open(self.index_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.entries.setdefault((url, entry.get('stop_at')), []).append(entry)
+
+    def replay(self, url, stop_at=None):
+        """Детерминированное воспроизведение: N-й запрос URL получает N-й записанный ответ
+        
+        Обрезанный запрос без своей записи получает полную страницу (в ней есть все до маркера)"""
+        self.load()
+        key = (url, self.marker_key(stop_at))
+        if key not in self.entries and stop_at:
+            key = (url, None)
+        entries = self.entries.get(key)
+        if not entries:
+            return None
+        position = self.replay_positions.get(key, 0)
+        self.replay_positions[key] = position + 1
+        entry = entries[min(position, len(entries) - 1)]
+        with open(self.body_path(entry['sha256']), 'rb') as f:
+            body = gzip.decompress(f.read())
+        return {
+            'url': url,
+            'status': entry['status'],
+            'content_type': entry['content_type'],
+            'body': body
+        }
+
+    def iter_pages(self):
+        """Последние полностью записанные HTML-страницы архива: (url, тело)"""
+        self.load()
+        for (url, stop_at), entries in self.entries.items():
+            if stop_at:
+                continue
+            entry = entries[-1]
+            if entry['status'] == 200 and 'html' in entry['content_type']:
+                with open(self.body_path(entry['sha256']), 'rb') as f:
+                    yield url, gzip.decompress(f.read())
+
+http_archive = None
+
+def get_http_archive():
+    """HTTP-архив создается при первом обращении (после чтения конфигурации)"""
+    global http_archive
+    if http_archive is None:
+        http_archive = HttpArchive(HTTP_ARCHIVE_DIR)
+    return http_archive
+
+async def read_until_marker(response, marker, max_bytes):
+    """Потоковое чтение тела до маркера (например, </head>) - остаток страницы не скачивается"""
+    marker = marker.lower()
+    buffer = bytearray()
+    async for chunk in response.content.iter_chunked(8192):
+        scan_from = max(0, len(buffer) - len(marker))
+        buffer.extend(chunk)
+        position = bytes(buffer[scan_from:]).lower().find(marker)
+        if position != -1:
+            return bytes(buffer[:scan_from + position + len(marker)])
+        if len(buffer) >= max_bytes:
+            break
+    return bytes(buffer[:max_bytes])
+
+def is_truncated(body, stop_at, max_bytes):
+    """Тело обрезано на max_bytes, так и не дойдя до маркера (конец может разрезать символ)"""
+    return bool(stop_at) and len(body) >= max_bytes and not body.lower().endswith(stop_at.lower())
+
+async def http_get(session, url, headers=None, timeout=15, stop_at=None, max_bytes=262144):
+    """GET-запрос через общий HTTP-слой с учетом режима записи/воспроизведения
+    
+    stop_at - байтовый маркер, после которого загрузка прерывается (тело обрезается)"""
+    METRICS['http_requests'] += 1
+    if HTTP_ARCHIVE_MODE == 'replay':
+        result = get_http_archive().replay(url, stop_at)
+        if result is None:
+            log.warning(f"Нет записи в архиве для {url}")
+            return {'url': url, 'status': 404, 'content_type': '', 'body': b''}
+        result['truncated'] = is_truncated(result['body'], stop_at, max_bytes)
+        return result
+    
+    async with session.get(url, headers=headers, timeout=timeout) as response:
+        result = {
+            'url': url,
+            'status': response.status,
+            'content_type': response.headers.get('content-type', ''),
+            'body': await (read_until_marker(response, stop_at, max_bytes) if stop_at else response.read())
+        }
+    result['truncated'] = is_truncated(result['body'], stop_at, max_bytes)
+    
+    if HTTP_ARCHIVE_MODE == 'record':
+        try:
+            get_http_archive().record(url, result['status'], result['content_type'], result['body'], stop_at)
+        except Exception as e:
+            log.warning(f"Ошибка записи в HTTP-архив: {e}")
+    
+    return result
+
+# Кодировки, выясненные для доменов: повторные ответы декодируются без определения
+SOURCE_CHARSETS = {}
+HEADER_CHARSET_PATTERN = re.compile(r'charset=["\']?([\w-]+)', re.IGNORECASE)
+DECLARED_CHARSET_PATTERN = re.compile(rb'(?:encoding|charset)\s*=\s*["\']?([\w-]+)', re.IGNORECASE)
+
+def normalize_charset(name):
+    """Каноническое имя кодировки или None, если Python ее не знает"""
+    try:
+        return codecs.lookup(name).name
+    except (LookupError, TypeError):
+        return None
+
+def response_charset(result):
+    """Кодировка ответа: заголовок, объявление в начале документа, затем кэш домена или проверка UTF-8
+    
+    Кэш заменяет только пробное декодирование: объявленная документом кодировка важнее выученной.
+    По обрезанному на max_bytes телу кодировка не запоминается - разрезанный символ не прошел бы проверку UTF-8"""
+    domain = urlparse(result.get('url', '')).netloc
+    match = HEADER_CHARSET_PATTERN.search(result.get('content_type', ''))
+    charset = normalize_charset(match.group(1)) if match else None
+    if not charset:
+        match = DECLARED_CHARSET_PATTERN.search(result['body'], 0, 2048)
+        charset = normalize_charset(match.group(1).decode('ascii')) if match else None
+    if charset:
+        SOURCE_CHARSETS[domain] = charset
+        return charset
+    if domain in SOURCE_CHARSETS:
+        return SOURCE_CHARSETS[domain]
+    
+    truncated = result.get('truncated', False)
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(result['body'], final=not truncated)
+        charset = 'utf-8'
+    except UnicodeDecodeError:
+        charset = 'cp1251'
+    if domain and not truncated:
+        SOURCE_CHARSETS[domain] = charset
+        log.debug("Кодировка %s: %s", domain, charset)
+    return charset
+
+def response_text(result):
+    """Декодирование тела ответа в известной для источника кодировке"""
+    return result['body'].decode(response_charset(result), errors='replace')
+
+# --- Оценка релевантности: автомат Ахо-Корасик по заголовку и описанию ---
+class KeywordAutomaton:
+    """Автомат Ахо-Корасик: поиск всех ключевых слов за один проход по тексту
+    
+    Ключ совпадает только с начала слова; пробел в конце ключа требует и конца слова"""
+
+    def __init__(self, keywords):
+        self.transitions = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+        
+        for keyword, value in keywords.items():
+            state = 0
+            normalized = normalize_for_matching(keyword)
+            for char in normalized:
+                next_state = self.transitions[state].get(char)
+                if next_state is None:
+                    next_state = len(self.transitions)
+                    self.transitions[state][char] = next_state
+                    self.transitions.append({})
+                    self.fail.append(0)
+                    self.outputs.append([])
+                state = next_state
+            self.outputs[state].append((keyword, value, len(normalized)))
+        
+        # Ссылки неудач строятся обходом в ширину
+        queue_states = deque(self.transitions[0].values())
+        while queue_states:
+            state = queue_states.popleft()
+            for char, next_state in self.transitions[state].items():
+                queue_states.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.transitions[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.transitions[fallback].get(char, 0)
+                self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.fail[next_state]]
+
+    def iter_matches(self, text):
+        """Все вхождения ключевых слов с начала слова: (позиция конца, ключевое слово, значение)"""
+        state = 0
+        transitions = self.transitions
+        fail = self.fail
+        # Знаки препинания считаются пробелами, пробел в конце текста закрывает последнее слово
+        for position, char in enumerate(text + ' '):
+            if not char.isalnum():
+                char = ' '
+            while state and char not in transitions[state]:
+                state = fail[state]
+            state = transitions[state].get(char, 0)
+            for keyword, value, length in self.outputs[state]:
+                start = position - length + 1
+                if start == 0 or not text[start - 1].isalnum():
+                    yield position, keyword, value
+
+    def matched_keywords(self, text):
+        """Словарь найденных ключевых слов (каждое учитывается один раз)"""
+        return {keyword.strip(): value for _, keyword, value in self.iter_matches(text)}
+
+def normalize_for_matching(text):
+    """Нижний регистр и ё → е для сопоставления ключевых слов"""
+    return text.lower().replace('ё', 'е')
+
+# Основы слов: совпадение с начала слова ловит падежные формы.
+# Многозначные основы заданы целыми словами (пробел в конце): «зенит», но не «зенитный»,
+# «метро», но не «километров», «пробка», но не «пробковый»
+SPB_RELEVANCE_KEYWORDS = {
+    'петербург': 3, 'питер': 3, 'спб': 3, 'ленинградск': 2, 'ленобласт': 2,
+    'смольн': 2, 'беглов': 2, 'невск': 2, 'васильевск': 2, 'петроград': 2,
+    'кронштадт': 2, 'петергоф': 2, 'колпин': 2, 'гатчин': 2, 'всеволожск': 2,
+    'пулков': 2, 'эрмитаж': 2, 'исаакиев': 2, 'купчин': 2, 'выборг': 2,
+    'лахта': 2, 'мариинск': 1, 'жкх': 1, 'метрополитен': 1, 'метро ': 1,
+    'зенит ': 1, 'зенита ': 1, 'зениту ': 1, 'зенитом ': 1, 'зените ': 1,
+    'пробка ': 1, 'пробки ': 1, 'пробке ': 1, 'пробку ': 1, 'пробкой ': 1, 'пробок ': 1, 'пробках ': 1
+}
+LOW_PUBLISHABILITY_KEYWORDS = {
+    'трансляция': -3, 'онлайн': -2, 'прямой эфир': -3, 'гороскоп': -3,
+    'видео': -1, 'фото дня': -1, 'курс доллара': -1, 'курс евро': -1
+}
+relevance_automaton = KeywordAutomaton({**SPB_RELEVANCE_KEYWORDS, **LOW_PUBLISHABILITY_KEYWORDS})
+FRESHNESS_WINDOW_HOURS = 24
+
+def parse_pub_date(value):
+    """Дата публикации из pubDate RSS (RFC 822) или Atom (ISO 8601) в ISO-формате"""
+    if not value:
+        return None
+    try:
+        try:
+            published = parsedate_to_datetime(value.strip())
+        except (TypeError, ValueError):
+            published = datetime.fromisoformat(value.strip())
+        if published.tzinfo is None:
+            published = published.replace(tzinfo=timezone.utc)
+        return published.isoformat()
+    except (TypeError, ValueError):
+        return None
+
+def score_news_item(item, now=None):
+    """Оценка новости: релевантность Петербургу, свежесть и ожидаемая пригодность к публикации"""
+    description = item.description or ''
+    
+    # Заголовок весит вдвое больше описания
+    title_matches = relevance_automaton.matched_keywords(item.normalized_title)
+    description_matches = relevance_automaton.matched_keywords(normalize_for_matching(description))
+    score = 2 * sum(title_matches.values()) + sum(
+        value for keyword, value in description_matches.items() if keyword not in title_matches)
+    
+    source = get_source_config(item.source)
+    if source['region'] == 'spb':
+        score += 2
+    score += source['priority']
+    
+    # Свежесть: линейно убывает за FRESHNESS_WINDOW_HOURS
+    if item.published:
+        now = now or clock.now()
+        age_hours = (now - datetime.fromisoformat(item.published)).total_seconds() / 3600
+        score += 4 * max(0.0, 1 - max(age_hours, 0) / FRESHNESS_WINDOW_HOURS)
+    else:
+        score += 2
+    
+    # Пригодность: длинное описание - больше шансов набрать текст, своя картинка - без заглушки
+    score += min(len(description.split()) / 20, 1.5)
+    if item.image:
+        score += 1
+    
+    return score
+
+def rank_news(items):
+    """Сортировка кандидатов по убыванию оценки (небольшой шум - для разнообразия при равенстве)"""
+    now = clock.now()
+    scored = [(score_news_item(item, now) + random.random() * 0.1, item) for item in items]
+    scored.sort(key=lambda pair: pair[0], reverse=True)
+    for score, item in scored[:5]:
+        log.debug("Кандидат %.2f: %s", score, item.title[:60])
+    return [item for _, item in scored]
+
 # --- Функции работы с изображениями ---
 def extract_image_from_item(item_soup):
     """Извлечение изображения из RSS элемента"""
@@ -651,17 +2085,35 @@ def extract_image_from_item(item_soup):
             continue
     return None
 
+META_TAG_PATTERN = re.compile(r'<meta\b[^>]*>', re.IGNORECASE)
+META_ATTR_PATTERN = re.compile(r'([\w:-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))')
+OG_PROPERTIES = ('og:image', 'og:title', 'og:description')
+
+def find_og_meta(html_content):
+    """Open Graph метаданные (og:image, og:title, og:description) из <head> без полного разбора HTML"""
+    found = {}
+    for tag in META_TAG_PATTERN.finditer(html_content):
+        attrs = {name.lower(): next(filter(None, values), '')
+                 for name, *values in META_ATTR_PATTERN.findall(tag.group(0))}
+        prop = (attrs.get('property') or attrs.get('name') or '').lower()
+        if prop in OG_PROPERTIES and prop not in found and attrs.get('content'):
+            found[prop] = html.unescape(attrs['content']).strip()
+            if len(found) == len(OG_PROPERTIES):
+                break
+    return found
+
+def is_image_url(url):
+    """Ссылка похожа на картинку поддерживаемого формата"""
+    return bool(url) and any(ext in url.lower() for ext in ['.jpg', '.jpeg', '.png', '.webp'])
+
 def find_og_image(html_content):
     """Поиск Open Graph изображения в HTML"""
     try:
-        soup = BeautifulSoup(html_content, 'html.parser')
-        og_image = soup.find('meta', property='og:image')
-        if og_image and og_image.get('content'):
-            url = og_image.get('content')
-            if url and any(ext in url.lower() for ext in ['.jpg', '.jpeg', '.png', '.webp']):
-                return url
+        url = find_og_meta(html_content).get('og:image')
+        if is_image_url(url):
+            return url
     except Exception as e:
-        print(f"⚠️ Ошибка поиска OG изображения: {e}")
+        log.warning(f"Ошибка поиска OG изображения: {e}")
     return None
 
 async def download_image(session, url):
@@ -680,177 +2132,387 @@ async def download_image(session, url):
             else:
                 return None
         
-        async with session.get(url, headers=headers, timeout=30) as response:
-            if response.status == 200:
-                content_type = response.headers.get('content-type', '')
-                if 'image' in content_type:
-                    filename = f"./temp_image_{int(time.time())}_{random.randint(1000, 9999)}.jpg"
-                    content = await response.read()
-                    
-                    if len(content) > 10240:  # Минимум 10KB
-                        with open(filename, 'wb') as f:
-                            f.write(content)
-                        return filename
-                    else:
-                        print(f"⚠️ Изображение слишком маленькое: {len(content)} байт")
+        response = await http_get(session, url, headers=headers, timeout=30)
+        if response['status'] == 200:
+            content_type = response['content_type']
+            if 'image' in content_type:
+                filename = f"./temp_image_{int(time.time())}_{random.randint(1000, 9999)}.jpg"
+                content = response['body']
+                
+                if len(content) > 10240:  # Минимум 10KB
+                    with open(filename, 'wb') as f:
+                        f.write(content)
+                    return filename
+                else:
+                    log.warning(f"Изображение слишком маленькое: {len(content)} байт")
                 
     except Exception as e:
-        print(f"⚠️ Ошибка скачивания изображения {url}: {e}")
+        log.warning(f"Ошибка скачивания изображения {url}: {e}")
     
     return None
 
 # --- Функции работы с новостями ---
-async def get_news_from_source(session, source_url, limit=5):
-    """Получение новостей из одного источника"""
-    try:
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
-        
-        print(f"🔍 Запрос к: {source_url}")
-        async with session.get(source_url, headers=headers, timeout=15) as response:
-            if response.status != 200:
-                print(f"⚠️ Ошибка {response.status} для {source_url}")
-                return []
+TRACKING_PARAM_PREFIXES = ('utm_', 'fbclid', 'gclid', 'yclid', 'from', 'ref')
+
+class NewsItem:
+    """Новость из ленты. Производные формы заголовка и ссылки вычисляются при первом обращении
+    и переиспользуются всеми этапами (заголовок и ссылка после создания не меняются)."""
+
+    __slots__ = ('title', 'link', 'description', 'source', 'image', 'published', 'text',
+                 '_clean_title', '_title_words', '_normalized_title', '_canonical_link', '_fingerprint')
+    FIELDS = ('title', 'link', 'description', 'source', 'image', 'published', 'text')
+
+    def __init__(self, title, link, description='', source='', image=None, published=None, text=None):
+        self.title = title
+        self.link = link
+        self.description = description
+        self.source = source
+        self.image = image
+        self.published = published
+        self.text = text  # текст статьи, извлеченный воркером
+        self._clean_title = None
+        self._title_words = None
+        self._normalized_title = None
+        self._canonical_link = None
+        self._fingerprint = None
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{field: data[field] for field in cls.FIELDS if field in data})
+
+    def to_dict(self):
+        data = {field: getattr(self, field) for field in self.FIELDS}
+        if data['text'] is None:
+            del data['text']
+        return data
+
+    @property
+    def news_id(self):
+        """Ключ новости в posted_news"""
+        return self.link or self.title
+
+    @property
+    def clean_title(self):
+        """Заголовок для подписи (create_engaging_title)"""
+        if self._clean_title is None:
+            self._clean_title = create_engaging_title(self.title)
+        return self._clean_title
+
+    @property
+    def title_words(self):
+        """Множество слов заголовка в нижнем регистре"""
+        if self._title_words is None:
+            self._title_words = get_title_words(self.title)
+        return self._title_words
+
+    @property
+    def normalized_title(self):
+        """Заголовок для поиска ключевых слов (нижний регистр, ё → е)"""
+        if self._normalized_title is None:
+            self._normalized_title = normalize_for_matching(self.title)
+        return self._normalized_title
+
+    @property
+    def canonical_link(self):
+        """Ссылка без фрагмента, меток отслеживания и завершающего слеша, хост в нижнем регистре"""
+        if self._canonical_link is None:
+            parts = urlparse(self.link)
+            query = '&'.join(pair for pair in parts.query.split('&')
+                             if pair and not pair.lower().startswith(TRACKING_PARAM_PREFIXES))
+            path = parts.path.rstrip('/') or '/'
+            self._canonical_link = f"{parts.scheme.lower()}://{parts.netloc.lower()}{path}" + (f"?{query}" if query else '')
+        return self._canonical_link
+
+    @property
+    def fingerprint(self):
+        """Отпечаток заголовка: одна и та же новость у разных изданий с тем же набором слов"""
+        if self._fingerprint is None:
+            words = ' '.join(sorted(re.sub(r'[^\w\s]', '', self.normalized_title).split()))
+            self._fingerprint = hashlib.blake2b(words.encode('utf-8'), digest_size=8).hexdigest()
+        return self._fingerprint
+
+def parse_feed(body, charset, source_url, limit=5, parser='rss'):
+    """Разбор RSS/Atom-ленты в список новостей (без сети - может выполняться в пуле процессов)"""
+    # Парсер получает байты и готовую кодировку - без угадывания и лишней копии строки
+    soup = load_bs4().BeautifulSoup(body, 'xml', from_encoding=charset)
+    atom = parser == 'atom'
+    
+    news_items = []
+    for item in soup.find_all('entry' if atom else 'item')[:limit]:
+        try:
+            title_elem = item.find('title')
+            link_elem = item.find('link')
+            description_elem = item.find('summary') or item.find('content') if atom else item.find('description')
+            pub_date_elem = item.find('published') or item.find('updated') if atom else item.find('pubDate')
+            
+            if not title_elem or not link_elem:
+                continue
                 
-            content = await response.text()
-            soup = BeautifulSoup(content, 'xml')
-            items = soup.find_all('item')[:limit]
+            title = title_elem.get_text().strip()
+            link = (link_elem.get('href') or '' if atom else link_elem.get_text()).strip()
+            description = ""
             
-            news_items = []
-            for item in items:
-                try:
-                    title_elem = item.find('title')
-                    link_elem = item.find('link')
-                    description_elem = item.find('description')
-                    
-                    if not title_elem or not link_elem:
-                        continue
-                        
-                    title = title_elem.get_text().strip()
-                    link = link_elem.get_text().strip()
-                    description = ""
-                    
-                    if description_elem:
-                        description = re.sub(r'<[^>]+>', '', description_elem.get_text()).strip()
-                    
-                    if not title or not link:
-                        continue
-                    
-                    # Ищем изображение в RSS
-                    image_url = extract_image_from_item(item)
-                    
-                    # Если изображения нет в RSS, ищем на странице
-                    if not image_url and link:
-                        try:
-                            async with session.get(link, headers=headers, timeout=8) as page_response:
-                                if page_response.status == 200:
-                                    page_content = await page_response.text()
-                                    image_url = find_og_image(page_content)
-                        except Exception as e:
-                            print(f"⚠️ Ошибка поиска изображения на странице: {e}")
-                    
-                    news_items.append({
-                        'title': title,
-                        'link': link,
-                        'description': description,
-                        'source': source_url,
-                        'image': image_url
-                    })
-                    
-                except Exception as e:
-                    print(f"⚠️ Ошибка обработки элемента в {source_url}: {e}")
-                    continue
+            if description_elem:
+                description = re.sub(r'<[^>]+>', '', description_elem.get_text()).strip()
             
-            print(f"✅ Получено {len(news_items)} новостей из {source_url}")
-            return news_items
+            if not title or not link:
+                continue
             
-    except Exception as e:
-        print(f"❌ Ошибка получения новостей из {source_url}: {e}")
-        return []
-
-async def get_all_news(limit_per_source=5):
-    """Получение новостей из всех источников"""
-    print("🔍 Получение новостей из источников...")
-    
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for source in NEWS_SOURCES:
-            task = get_news_from_source(session, source, limit_per_source)
-            tasks.append(task)
-            await asyncio.sleep(1)
+            news_items.append(NewsItem(
+                title,
+                link,
+                description,
+                source_url,
+                # Ищем изображение в RSS
+                image=extract_image_from_item(item),
+                published=parse_pub_date(pub_date_elem.get_text()) if pub_date_elem else None
+            ))
+            
+        except Exception as e:
+            log.warning(f"Ошибка обработки элемента в {source_url}: {e}")
+            continue
+    
+    return news_items
+
+feed_parse_pool = None
+
+def get_feed_parse_pool():
+    """Пул процессов для разбора лент (None - разбор в основном процессе)"""
+    global feed_parse_pool
+    if feed_parse_pool is None and FEED_PARSE_WORKERS > 0:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # spawn: дочерние процессы не наследуют потоки логирования и открытые соединения
+        feed_parse_pool = ProcessPoolExecutor(max_workers=FEED_PARSE_WORKERS,
+                                              mp_context=multiprocessing.get_context('spawn'))
+    return feed_parse_pool
+
+def close_feed_parse_pool():
+    """Остановка пула разбора лент"""
+    global feed_parse_pool
+    if feed_parse_pool is not None:
+        feed_parse_pool.shutdown(cancel_futures=True)
+        feed_parse_pool = None
+
+async def parse_feed_response(response, source):
+    """Разбор ответа ленты - в пуле процессов, если он включен"""
+    args = (response['body'], response_charset(response), source['url'], source['limit'], source['parser'])
+    pool = get_feed_parse_pool()
+    if pool is None:
+        return parse_feed(*args)
+    return await asyncio.get_running_loop().run_in_executor(pool, parse_feed, *args)
+
+async def get_news_from_source(session, source_url, limit=None):
+    """Получение новостей из одного источника; None - источник не ответил (в отличие от пустого списка)"""
+    try:
+        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
+        source = get_source_config(source_url)
+        if limit:
+            source = dict(source, limit=limit)
         
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+        started = time.perf_counter()
+        log.debug("Запрос к: %s", source_url)
+        response = await http_get(session, source_url, headers=headers, timeout=15)
+        if response['status'] != 200:
+            log.warning(f"Ошибка {response['status']} для {source_url}")
+            return None
+        mark_health('last_fetch')
         
-        all_news = []
-        for result in results:
-            if isinstance(result, list):
-                all_news.extend(result)
+        news_items = await parse_feed_response(response, source)
+        parsed_count = len(news_items)
+        
+        # Уже виденные записи дальше не идут - ни поиска картинок, ни извлечения текста
+        # (знак сдвинется, когда записи попадут в пул кандидатов)
+        try:
+            news_items = filter_new_items(source_url, news_items)
+        except (sqlite3.Error, ValueError) as e:
+            log.warning(f"Ошибка водяного знака {source_url}: {e}")
         
-        print(f"✅ Получено {len(all_news)} новостей из {len(NEWS_SOURCES)} источников")
-        return all_news
+        # Если изображения нет в ленте, ищем на странице - скачиваем только <head>
+        for item in news_items:
+            if item.image:
+                continue
+            try:
+                page_response = await http_get(session, item.link, headers=headers, timeout=8, stop_at=b'</head>')
+                if page_response['status'] == 200:
+                    og_meta = find_og_meta(response_text(page_response))
+                    if is_image_url(og_meta.get('og:image')):
+                        item.image = og_meta['og:image']
+                    if not item.description:
+                        item.description = og_meta.get('og:description', '')
+            except Exception as e:
+                log.warning(f"Ошибка поиска изображения на странице: {e}")
+        
+        log.debug("Получено %d новых из %d записей %s", len(news_items), parsed_count, source_url,
+                  extra={'fields': {'source': source_url, 'items': len(news_items), 'parsed': parsed_count,
+                                    'ms': round((time.perf_counter() - started) * 1000)}})
+        return news_items
+        
+    except Exception as e:
+        log.error(f"Ошибка получения новостей из {source_url}: {e}")
+        return None
+
+class SingleFlight:
+    """Объединение одновременных одинаковых вызовов: выполняется один, остальные ждут его результат"""
+
+    def __init__(self):
+        self.in_flight = {}
+
+    async def run(self, key, factory):
+        future = self.in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self.in_flight[key] = future
+            future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            log.debug("Ожидание уже идущего вызова %s", key[0])
+        # Отмена одного ожидающего не отменяет общий вызов
+        return await asyncio.shield(future)
+
+news_refresh = SingleFlight()
+
+async def poll_source(session, source_url, limit=None):
+    """Опрос источника с пересчетом его интервала (одновременные опросы источника объединяются)
+    
+    None - опрос не удался: ничего не сохраняем и не считаем источник обработанным"""
+    async def fetch():
+        items = await get_news_from_source(session, source_url, limit)
+        if items is None:
+            delay = record_source_poll(source_url, None)
+            log.info(f"{source_url}: опрос не удался, повтор через ~{int(delay)} с")
+            return None
+        interval = record_source_poll(source_url, len(items))
+        log.debug("%s: %d новых, следующий опрос через ~%d с", source_url, len(items), interval)
+        return items
+    items = await news_refresh.run(('poll', source_url, limit), fetch)
+    return None if items is None else list(items)
+
+async def get_all_news(limit_per_source=None, sources=None):
+    """Получение новостей из всех источников; одновременные запросы тех же источников разделяют одну загрузку"""
+    sources = sources or NEWS_SOURCES
+    key = ('refresh', frozenset(sources), limit_per_source)
+    return list(await news_refresh.run(key, lambda: fetch_all_news(limit_per_source, sources)))
+
+async def fetch_all_news(limit_per_source=None, sources=None):
+    """Загрузка новостей из источников (лимит по умолчанию - из реестра источников)"""
+    log.info("Получение новостей из источников...")
+    sources = sources or NEWS_SOURCES
+    
+    # Источники, которые недавно обработали воркеры, повторно не запрашиваем;
+    # остальные - только когда подошел их срок опроса (записи прошлых опросов ждут в пуле)
+    prefetched = fresh_worker_sources(sources)
+    if prefetched:
+        log.info(f"Кандидаты от воркеров: {len(prefetched)} источников")
+    try:
+        due = [source for source in due_sources(sources) if source not in prefetched]
+    except sqlite3.Error as e:
+        log.warning(f"Ошибка чтения расписания опроса: {e}")
+        due = [source for source in sources if source not in prefetched]
+    
+    session = get_http_session()
+    # Вместо паузы между запросами - ограничение числа одновременных загрузок
+    semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+    
+    async def fetch(source):
+        async with semaphore:
+            return source, await poll_source(session, source, limit_per_source)
+    
+    results = await asyncio.gather(*(fetch(source) for source in due), return_exceptions=True)
+    
+    fresh_news = []
+    try:
+        for result in results:
+            if isinstance(result, tuple) and result[1] is not None:
+                source, items = result
+                fresh_news.extend(items)
+                store_candidates(source, items, mark_fetched=False)
+        # Новые записи плюс не опубликованные в прошлых циклах
+        all_news = load_candidates(sources)
+    except (sqlite3.Error, ValueError) as e:
+        log.warning(f"Ошибка пула кандидатов: {e}")
+        all_news = fresh_news
+    
+    log.info(f"Получено {len(fresh_news)} новых ({len(due)} опрошено), в пуле {len(all_news)} новостей из {len(sources)} источников",
+             extra={'fields': {'new': len(fresh_news), 'items': len(all_news), 'sources': len(sources), 'polled': len(due)}})
+    return all_news
 
 async def get_extended_news_text(link, title, session):
     """Получение расширенного текста новости со страницы"""
     if not link:
         return ""
+    
+    # Текст уже извлекался (например, для другого канала)
+    if link in ARTICLE_TEXT_CACHE:
+        ARTICLE_TEXT_CACHE.move_to_end(link)
+        return ARTICLE_TEXT_CACHE[link]
         
     try:
         headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
-        async with session.get(link, headers=headers, timeout=10) as response:
-            if response.status == 200:
-                html = await response.text()
-                return extract_complete_text_from_html(html, title)
+        response = await http_get(session, link, headers=headers, timeout=10)
+        if response['status'] == 200:
+            text = extract_complete_text_from_html(response_text(response), title, link)
+            if text:
+                cache_put(ARTICLE_TEXT_CACHE, link, text)
+            return text
                     
     except Exception as e:
-        print(f"⚠️ Ошибка получения текста новости: {e}")
+        log.warning(f"Ошибка получения текста новости: {e}")
     
     return ""
 
 async def prepare_news_item(item):
     """Подготовка новости к публикации - ПРИОРИТЕТ КАРТИНКЕ ИЗ НОВОСТИ"""
-    title = item.get('title', 'Без заголовка')
-    link = item.get('link', '')
-    description = item.get('description', '')
-    image_url = item.get('image', '')
+    title = item.title or 'Без заголовка'
+    link = item.link
+    description = item.description
+    image_url = item.image
     
-    print(f"📝 Подготовка: {title[:60]}...")
+    log.debug("Подготовка: %s", title[:60])
+    METRICS['items_prepared'] += 1
     
     # Получаем полный текст новости
     news_text = ""
     if link:
-        async with aiohttp.ClientSession() as session:
-            news_text = await get_extended_news_text(link, title, session)
+        news_text = await get_extended_news_text(link, title, get_http_session())
     
     # Форматируем в стиле Live Питер
-    final_text = format_news_live_piter_style(title, description, news_text)
+    final_text = format_news_live_piter_style(title, description, news_text, clean_title=item.clean_title)
     
     # Проверяем минимальную длину
     word_count = len(final_text.split())
     if word_count < 40:
-        print(f"❌ Пропущена новость: '{title[:30]}...' - недостаточно текста ({word_count} слов)")
+        METRICS['items_rejected'] += 1
+        log.info(f"Пропущена новость: '{title[:30]}...' - недостаточно текста ({word_count} слов)")
         return None
     
-    print(f"✅ Текст подготовлен: {word_count} слов")
+    log.debug("Текст подготовлен: %d слов", word_count)
     
     # Работа с изображением - ПРИОРИТЕТ КАРТИНКЕ ИЗ НОВОСТИ
     image_path = None
-    
-    # Сначала пробуем скачать изображение из новости
-    if image_url:
-        print(f"🖼️ Пытаемся скачать изображение из новости: {image_url}")
-        async with aiohttp.ClientSession() as session:
-            image_path = await download_image(session, image_url)
-            if image_path:
-                print("✅ Используем изображение из новости")
-            else:
-                print("⚠️ Не удалось скачать изображение из новости")
+    image_key = None
+    
+    if image_url and image_url in IMAGE_FILE_IDS:
+        # Изображение уже загружено в Telegram - повторно не скачиваем
+        image_key = image_url
+        log.debug("Используем уже загруженное изображение из новости (file_id)")
+    elif image_url:
+        # Сначала пробуем скачать изображение из новости
+        log.debug("Пытаемся скачать изображение из новости: %s", image_url)
+        image_path = await download_image(get_http_session(), image_url)
+        if image_path:
+            image_key = image_url
+            log.debug("Используем изображение из новости")
+        else:
+            log.warning("Не удалось скачать изображение из новости")
     
     # Если нет изображения из новости - используем заглушку из static
-    if not image_path:
+    if not image_key:
         if DEFAULT_PLACEHOLDER_PATH and os.path.exists(DEFAULT_PLACEHOLDER_PATH):
             image_path = DEFAULT_PLACEHOLDER_PATH
-            print("✅ Используем заглушку из папки static")
+            image_key = DEFAULT_PLACEHOLDER_PATH
+            log.debug("Используем заглушку из папки static")
         else:
-            print("❌ Нет ни изображения новости, ни заглушки!")
+            log.error("Нет ни изображения новости, ни заглушки!")
             return None
     
     return {
@@ -858,133 +2520,199 @@ async def prepare_news_item(item):
         'summary': final_text,
         'link': link,
         'image_path': image_path,
+        'image_key': image_key,
         'word_count': word_count,
-        'is_placeholder': image_path == DEFAULT_PLACEHOLDER_PATH
+        'is_placeholder': image_key == DEFAULT_PLACEHOLDER_PATH
     }
 
-async def send_news_to_channel(news_item):
+def cleanup_prepared_item(news_item):
+    """Удаление временного файла изображения после рассылки по всем каналам"""
+    image_path = news_item.get('image_path')
+    if image_path and 'temp_image_' in image_path and os.path.exists(image_path):
+        try:
+            os.remove(image_path)
+            log.debug("Временный файл изображения удален")
+        except Exception as e:
+            log.warning(f"Не удалось удалить временный файл: {e}")
+
+async def send_news_to_channel(news_item, channel=None):
     """Отправка новости в канал"""
     try:
+        channel_id = (channel or PRIMARY_CHANNEL)['id']
         title = news_item['title']
         summary = news_item['summary']
         image_path = news_item['image_path']
-        word_count = news_item['word_count']
+        image_key = news_item.get('image_key')
         is_placeholder = news_item.get('is_placeholder', False)
         
         image_type = "заглушку" if is_placeholder else "изображение из новости"
-        print(f"📤 Отправка новости: {title[:50]}... ({image_type})")
+        log.debug("Отправка новости в %s: %s (%s)", channel_id, title[:50], image_type)
         
         # Форматируем сообщение
         message_text = summary
+        file_id = IMAGE_FILE_IDS.get(image_key) if image_key else None
         
-        if image_path and os.path.exists(image_path):
-            try:
-                with open(image_path, 'rb') as photo:
+        try:
+            if file_id:
+                # Повторная отправка без загрузки файла
+                try:
                     await bot.send_photo(
-                        CHANNEL_ID,
+                        channel_id,
+                        file_id,
+                        caption=message_text,
+                        parse_mode='HTML'
+                    )
+                except Exception as e:
+                    # file_id из снимка прошлого запуска мог стать недействительным (например, после смены токена)
+                    log.warning(f"Отправка по file_id не удалась, загружаем изображение заново: {e}")
+                    IMAGE_FILE_IDS.pop(image_key, None)
+                    file_id = None
+                    if not (image_path and os.path.exists(image_path)):
+                        image_path = await download_image(get_http_session(), image_key)
+                        # Временный файл удалит cleanup_prepared_item после рассылки
+                        news_item['image_path'] = image_path
+            if not file_id:
+                if not (image_path and os.path.exists(image_path)):
+                    log.error("Изображение не найдено, новость не отправлена")
+                    return False
+                with open(image_path, 'rb') as photo:
+                    sent_message = await bot.send_photo(
+                        channel_id,
                         photo,
                         caption=message_text,
                         parse_mode='HTML'
                     )
-                print(f"✅ Новость с {image_type} отправлена")
-                
-                # Удаляем временные файлы (кроме заглушки из static)
-                if 'temp_image_' in image_path:
-                    try:
-                        os.remove(image_path)
-                        print("✅ Временный файл изображения удален")
-                    except Exception as e:
-                        print(f"⚠️ Не удалось удалить временный файл: {e}")
-                        
-                return True
-            except Exception as e:
-                print(f"❌ Ошибка отправки с изображением: {e}")
-                return False
-        else:
-            print("❌ Изображение не найдено, новость не отправлена")
+                if image_key and sent_message and sent_message.photo:
+                    cache_put(IMAGE_FILE_IDS, image_key, sent_message.photo[-1].file_id)
+            
+            log.info(f"Новость с {image_type} отправлена в {channel_id}",
+                     extra={'fields': {'channel': channel_id, 'link': news_item.get('link')}})
+            return True
+        except Exception as e:
+            log.error(f"Ошибка отправки с изображением: {e}")
             return False
         
     except Exception as e:
-        print(f"❌ Ошибка отправки новости: {e}")
+        log.error(f"Ошибка отправки новости: {e}")
         return False
 
-async def publish_news(count=1):
-    """Публикация указанного количества новостей"""
-    print(f"🚀 Запуск публикации {count} новостей...")
+async def publish_news(count=1, channels=None):
+    """Публикация новостей: одно получение и подготовка на все каналы, рассылка по каждому"""
+    new_cycle_id('publish')
+    log.info(f"Запуск публикации {count} новостей...")
     
     # Проверяем наличие заглушки
     if not (DEFAULT_PLACEHOLDER_PATH and os.path.exists(DEFAULT_PLACEHOLDER_PATH)):
-        print("❌ КРИТИЧЕСКАЯ ОШИБКА: Заглушка не найдена! Публикация невозможна.")
+        log.error("КРИТИЧЕСКАЯ ОШИБКА: Заглушка не найдена! Публикация невозможна.")
         return 0
     
     # Проверяем лимиты и время
-    if not can_post_more_today():
-        print(f"❌ Достигнут дневной лимит: {DAILY_POST_COUNTER}/{MAX_DAILY_POSTS}")
-        return 0
-    
-    if not is_posting_time():
-        moscow_time = get_moscow_time()
-        print(f"❌ Сейчас запрещенное время для постинга: Москва {moscow_time.strftime('%H:%M')}")
+    active_channels = get_active_channels(channels)
+    if not active_channels:
+        if not can_post_more_today():
+            log.info(f"Достигнут дневной лимит: {DAILY_POST_COUNTER}/{MAX_DAILY_POSTS}")
+        else:
+            moscow_time = get_moscow_time()
+            log.info(f"Сейчас запрещенное время для постинга: Москва {moscow_time.strftime('%H:%M')}")
         return 0
     
-    all_news = await get_all_news()
+    # Источники собираем один раз для всех активных каналов
+    sources = [source for source in NEWS_SOURCES
+               if any(channel_accepts_source(channel, source) for channel in active_channels)]
+    all_news = await get_all_news(sources=sources)
     if not all_news:
-        print("⚠️ Новости не найдены")
+        log.info("Новости не найдены")
         return 0
     
-    # Фильтруем только новые новости
+    def channels_for(item, news_id, published):
+        """Каналы, которым еще нужна эта новость"""
+        return [channel for channel in active_channels
+                if published[channel['id']] < count
+                and channel_accepts_source(channel, item.source)
+                and posted_key(channel, news_id) not in CLAIMED_KEYS
+                and posted_key(channel, news_id) not in posted_news
+                and can_post_more_today(channel)]
+    
+    published = {channel['id']: 0 for channel in active_channels}
+    
+    # Фильтруем только новые новости; одну историю из нескольких изданий оставляем один раз
     new_news = []
+    seen_stories = set()
     for item in all_news:
-        news_id = item.get('link') or item.get('title')
-        if news_id and news_id not in posted_news:
+        news_id = item.news_id
+        if not news_id or item.canonical_link in seen_stories or item.fingerprint in seen_stories:
+            continue
+        if channels_for(item, news_id, published):
+            seen_stories.update((item.canonical_link, item.fingerprint))
             new_news.append(item)
     
+    global LAST_QUEUE_DEPTH
+    LAST_QUEUE_DEPTH = len(new_news)
+    
     if not new_news:
-        print("ℹ️ Нет новых новостей для публикации")
+        log.info("Нет новых новостей для публикации")
         return 0
     
-    # Перемешиваем для разнообразия
-    random.shuffle(new_news)
+    # Первыми готовим самые релевантные и свежие новости
+    new_news = rank_news(new_news)
     
     published_count = 0
-    attempts = 0
     max_attempts = min(len(new_news) * 2, 15)
     
-    while published_count < count and attempts < max_attempts and can_post_more_today():
-        if attempts >= len(new_news):
+    for item in new_news[:max_attempts]:
+        if all(published[channel['id']] >= count or not can_post_more_today(channel)
+               for channel in active_channels):
             break
-            
-        item = new_news[attempts]
-        attempts += 1
         
+        news_id = item.news_id
+        # Захват до первого await: параллельный /post или /wake эту новость и эту квоту уже не возьмет
+        target_channels = claim_posts(channels_for(item, news_id, published), news_id)
+        if not target_channels:
+            continue
+        
+        sent_any = False
         try:
+            # Подготовка один раз - рассылка во все подходящие каналы
             prepared_item = await prepare_news_item(item)
             
             if prepared_item is None:
+                # Водяной знак источника запись уже прошла - из ленты она в пул не вернется
+                discard_candidate(item.link)
                 continue
-                
-            success = await send_news_to_channel(prepared_item)
             
-            if success:
-                news_id = item.get('link') or item.get('title')
-                if news_id:
-                    posted_news.add(news_id)
-                    published_count += 1
-                    increment_daily_counter()
-                    save_posted_news(posted_news)
-                
-                # Задержка между публикациями
-                await asyncio.sleep(random.randint(45, 120))
+            try:
+                for channel in target_channels:
+                    success = await send_news_to_channel(prepared_item, channel)
+                    if success:
+                        posted_news.add(posted_key(channel, news_id))
+                        published[channel['id']] += 1
+                        published_count += 1
+                        METRICS['posts'] += 1
+                        increment_daily_counter(channel)
+                        sent_any = True
+            finally:
+                cleanup_prepared_item(prepared_item)
                 
         except Exception as e:
-            print(f"❌ Ошибка публикации новости: {e}")
+            log.error(f"Ошибка публикации новости: {e}")
             continue
-    
-    print(f"✅ Опубликовано новостей: {published_count} из {count} запланированных")
+        finally:
+            release_posts(target_channels, news_id)
+        
+        if sent_any:
+            save_posted_news(posted_news)
+            
+            # Задержка между публикациями
+            await clock.sleep(random.randint(45, 120))
+    
+    if published_count:
+        mark_startup('first_publish_ms')
+        mark_health('last_publish')
+    log.info(f"Опубликовано новостей: {published_count} из {count * len(active_channels)} запланированных",
+             extra={'fields': {'published': published_count, 'planned': count * len(active_channels)}})
     return published_count
 
 # --- Команды бота ---
-@bot.message_handler(commands=['start'])
 async def send_welcome(message):
     welcome_text = """
 🤖 Новостной бот для канала "Live Питер 📸"
@@ -1002,7 +2730,7 @@ async def send_welcome(message):
 • Заглушка из static как резервный вариант
 • Защита от множественных запусков
 • Улучшенный keep-alive для Render
-• Расписание: 1-2 новости в час
+• Расписание: равномерно по дневному лимиту
 
 📋 Команды:
 /post - Опубликовать новости
@@ -1014,7 +2742,6 @@ async def send_welcome(message):
 """
     await bot.reply_to(message, welcome_text)
 
-@bot.message_handler(commands=['wake'])
 async def force_wake(message):
     """Принудительная активация бота"""
     try:
@@ -1032,7 +2759,6 @@ async def force_wake(message):
     except Exception as e:
         await bot.reply_to(message, f"❌ Ошибка активации: {e}")
 
-@bot.message_handler(commands=['post'])
 async def manual_post(message):
     try:
         # Проверяем наличие заглушки
@@ -1041,13 +2767,12 @@ async def manual_post(message):
             return
             
         # Проверяем лимиты перед публикацией
-        if not can_post_more_today():
-            await bot.reply_to(message, f"❌ Достигнут дневной лимит: {DAILY_POST_COUNTER}/{MAX_DAILY_POSTS}")
-            return
-        
-        if not is_posting_time():
-            moscow_time = get_moscow_time()
-            await bot.reply_to(message, f"❌ Сейчас запрещенное время для постинга: Москва {moscow_time.strftime('%H:%M')}")
+        if not get_active_channels():
+            if not can_post_more_today():
+                await bot.reply_to(message, f"❌ Достигнут дневной лимит: {DAILY_POST_COUNTER}/{MAX_DAILY_POSTS}")
+            else:
+                moscow_time = get_moscow_time()
+                await bot.reply_to(message, f"❌ Сейчас запрещенное время для постинга: Москва {moscow_time.strftime('%H:%M')}")
             return
             
         await bot.reply_to(message, "⏳ Запускаю публикацию новостей...")
@@ -1057,7 +2782,6 @@ async def manual_post(message):
     except Exception as e:
         await bot.reply_to(message, f"❌ Ошибка: {e}")
 
-@bot.message_handler(commands=['status'])
 async def bot_status(message):
     moscow_time = get_moscow_time()
     
@@ -1067,11 +2791,12 @@ async def bot_status(message):
 📊 Статус бота (ВЕРСИЯ 7.7):
 
 🤖 Бот: Активен с защитой от дублирования
+📺 Каналы: {', '.join(channel['id'] for channel in CHANNELS)}
 📰 Источников: {len(NEWS_SOURCES)}
 📨 Опубликовано всего: {len(posted_news)}
 📨 Опубликовано сегодня: {DAILY_POST_COUNTER}/{MAX_DAILY_POSTS}
 🎯 Формат: Компактные новости (2-3 абзаца)
-⏰ Расписание: 1-2 новости в час (07:00-23:50 МСК)
+⏰ Расписание: равномерно по дневному лимиту (07:00-23:50 МСК)
 🌐 Внешний ping: {'✅ Включен' if RENDER_APP_URL else '❌ Выключен'}
 🖼️ Заглушка: {placeholder_status}
 🔒 Защита: ✅ Активна
@@ -1079,11 +2804,10 @@ async def bot_status(message):
 🕒 Текущее время: {moscow_time.strftime('%H:%M')} МСК
 🧹 Очистка текста: ✅ УЛУЧШЕННАЯ (без лишних пробелов)
 💡 Режим: ПРИОРИТЕТ картинкам из новостей
-📈 Публикация: 1-2 поста в час
+📈 Публикация: слоты по дневному лимиту
 """
     await bot.reply_to(message, status_text)
 
-@bot.message_handler(commands=['stats'])
 async def bot_stats(message):
     stats_text = f"""
 📈 Статистика:
@@ -1099,11 +2823,10 @@ async def bot_stats(message):
     
     await bot.reply_to(message, stats_text)
 
-@bot.message_handler(commands=['sources'])
 async def show_sources(message):
     sources_text = "📰 Источники новостей:\n\n"
     
-    federal = [s for s in NEWS_SOURCES if 'lenta' in s or 'tass' in s or 'rambler' in s or 'ria' in s or 'interfax' in s or 'kommersant' in s]
+    federal = [s for s in NEWS_SOURCES if get_source_region(s) == 'federal']
     local = [s for s in NEWS_SOURCES if s not in federal]
     
     sources_text += "🏛️ Федеральные:\n"
@@ -1118,12 +2841,17 @@ async def show_sources(message):
     
     await bot.reply_to(message, sources_text)
 
-@bot.message_handler(commands=['limits'])
 async def show_limits(message):
     """Показать текущие лимиты и временные ограничения"""
     reset_daily_counter_if_needed()
     moscow_time = get_moscow_time()
     
+    channels_text = "\n".join(
+        f"• {channel['id']}: {get_daily_post_count(channel)}/{channel['max_daily_posts']}, "
+        f"окно {channel['posting_window']}, сейчас {'✅' if is_posting_time(channel) else '❌'}"
+        for channel in CHANNELS
+    )
+    
     limits_text = f"""
 📋 Лимиты и ограничения:
 
@@ -1134,115 +2862,620 @@ async def show_limits(message):
 📈 Можно опубликовать сегодня: {MAX_DAILY_POSTS - DAILY_POST_COUNTER}
 🖼️ Заглушка: {'✅ Доступна' if (DEFAULT_PLACEHOLDER_PATH and os.path.exists(DEFAULT_PLACEHOLDER_PATH)) else '❌ ОТСУТСТВУЕТ - ПУБЛИКАЦИЯ НЕВОЗМОЖНА'}
 
+📺 Каналы:
+{channels_text}
+
 💡 Примечания:
 • Лимит сбрасывается в 00:00 по Москве
 • Время 23:50-07:00 - перерыв для пользователей
 • Максимум {MAX_DAILY_POSTS} постов в сутки
 • УЛУЧШЕННАЯ очистка от лишних пробелов
 • ПРИОРИТЕТ картинкам из новостей, заглушка как резерв
-• Расписание: 1-2 новости каждый час
+• Расписание: слоты равномерно по дневному лимиту
 """
     await bot.reply_to(message, limits_text)
 
+def register_handlers(bot):
+    """Регистрация команд бота"""
+    bot.register_message_handler(send_welcome, commands=['start'])
+    bot.register_message_handler(force_wake, commands=['wake'])
+    bot.register_message_handler(manual_post, commands=['post'])
+    bot.register_message_handler(bot_status, commands=['status'])
+    bot.register_message_handler(bot_stats, commands=['stats'])
+    bot.register_message_handler(show_sources, commands=['sources'])
+    bot.register_message_handler(show_limits, commands=['limits'])
+
 async def auto_poster():
-    """Фоновая задача автоматической публикации - 1-2 новости в час"""
-    print("🔄 Запуск автоматической публикации (1-2 новости в час)...")
+    """Фоновая задача автоматической публикации по расписанию из окна постинга и дневного лимита"""
+    log.info("Запуск автоматической публикации (слоты по дневному лимиту)...")
     
     while True:
         try:
             # Проверяем наличие заглушки
             if not (DEFAULT_PLACEHOLDER_PATH and os.path.exists(DEFAULT_PLACEHOLDER_PATH)):
-                print("❌ КРИТИЧЕСКАЯ ОШИБКА: Заглушка не найдена! Автопостинг приостановлен.")
-                await asyncio.sleep(3600)  # Ждем час перед повторной проверкой
+                log.error("КРИТИЧЕСКАЯ ОШИБКА: Заглушка не найдена! Автопостинг приостановлен.")
+                await clock.sleep(3600)  # Ждем час перед повторной проверкой
                 continue
             
-            # Проверяем можно ли постить (время и лимиты)
-            if is_posting_time() and can_post_more_today():
-                # Публикуем 1-2 новости случайным образом
-                news_count = random.randint(1, 2)
-                print(f"📰 Автопостинг: публикую {news_count} новость(и)...")
+            # Проверяем можно ли постить хотя бы в один канал (время и лимиты)
+            active_channels = get_active_channels()
+            if active_channels:
+                news_count = max(plan_posts_per_slot(channel) for channel in active_channels)
+                log.info(f"Автопостинг: публикую {news_count} новость(и)...")
+                requests_before = METRICS['http_requests']
+                rejected_before = METRICS['items_rejected']
                 published = await publish_news(news_count)
                 
+                # Впустую: все запросы слота без публикаций, иначе - статьи отброшенных новостей
+                if published > 0:
+                    METRICS['wasted_fetches'] += METRICS['items_rejected'] - rejected_before
+                else:
+                    METRICS['wasted_fetches'] += METRICS['http_requests'] - requests_before
+                
                 if published > 0:
-                    print(f"✅ Успешно опубликовано {published} новостей")
+                    log.info(f"Успешно опубликовано {published} новостей")
                 else:
-                    print("❌ Не удалось опубликовать новости")
+                    log.warning("Не удалось опубликовать новости")
             else:
                 if not is_posting_time():
                     moscow_time = get_moscow_time()
-                    print(f"💤 Запрещенное время: Москва {moscow_time.strftime('%H:%M')}, автопостинг приостановлен")
+                    log.info(f"Запрещенное время: Москва {moscow_time.strftime('%H:%M')}, автопостинг приостановлен")
                 else:
-                    print(f"📊 Достигнут лимит: {DAILY_POST_COUNTER}/{MAX_DAILY_POSTS}")
+                    log.info(f"Достигнут лимит: {DAILY_POST_COUNTER}/{MAX_DAILY_POSTS}")
             
-            # Ждем 1 час до следующей публикации
-            sleep_time = 3600  # 1 час в секундах
-            next_check = datetime.now(timezone.utc) + timedelta(seconds=sleep_time)
+            # Следующий слот - ближайший среди всех каналов
+            sleep_time = min(plan_next_publish(channel, LAST_QUEUE_DEPTH) for channel in CHANNELS)
             moscow_time_next = get_moscow_time() + timedelta(seconds=sleep_time)
             
-            print(f"⏳ Следующая публикация через 1 час в {moscow_time_next.strftime('%H:%M')} МСК...")
-            await asyncio.sleep(sleep_time)
+            log.info(f"Следующая публикация через {int(sleep_time // 60)} мин в {moscow_time_next.strftime('%H:%M')} МСК...")
+            await clock.sleep(sleep_time)
             
         except Exception as e:
-            print(f"⚠️ Ошибка в авто-постинге: {e}")
-            # При ошибке ждем 30 минут перед повторной попыткой
-            await asyncio.sleep(1800)
+            log.warning(f"Ошибка в авто-постинге: {e}")
+            # При ошибке ждем минимальный интервал перед повторной попыткой
+            await clock.sleep(PUBLISH_MIN_INTERVAL)
+
+# --- Бенчмарки ---
+TITLE_TAG_PATTERN = re.compile(r'<title[^>]*>(.*?)</title>', re.IGNORECASE | re.DOTALL)
+
+def html_title(page_html):
+    """Содержимое <title> страницы"""
+    match = TITLE_TAG_PATTERN.search(page_html)
+    return html.unescape(match.group(1)).strip() if match else ''
+
+def bench_extract(iterations=10):
+    """Замер времени извлечения текста по HTML-страницам из HTTP-архива"""
+    pages = [(url, response_text({'body': body, 'content_type': ''}))
+             for url, body in get_http_archive().iter_pages()]
+    if not pages:
+        log.warning(f"В HTTP-архиве {HTTP_ARCHIVE_DIR} нет HTML-страниц, сначала запишите трафик (HTTP_ARCHIVE_MODE=record)")
+        return
+    
+    total = 0.0
+    for url, page_html in pages:
+        title = html_title(page_html)
+        started = time.perf_counter()
+        for _ in range(iterations):
+            extract_complete_text_from_html(page_html, title, url)
+        elapsed_ms = (time.perf_counter() - started) * 1000 / iterations
+        total += elapsed_ms
+        log.info(f"Извлечение {url}: {elapsed_ms:.1f} мс",
+                 extra={'fields': {'url': url, 'ms': round(elapsed_ms, 2), 'bytes': len(page_html)}})
+    
+    log.info(f"Среднее время извлечения: {total / len(pages):.1f} мс на статью",
+             extra={'fields': {'pages': len(pages), 'avg_ms': round(total / len(pages), 2)}})
+
+# --- Пакетная обработка: JSONL со ссылками или сохраненным HTML → JSONL с подписями ---
+async def process_batch_item(session, request):
+    """Одна запись пакета: загрузка (или сохраненный HTML), извлечение текста, подпись и картинка"""
+    timings = {}
+    started = time.perf_counter()
+    url = request.get('url', '')
+    
+    page_html = request.get('html')
+    if page_html is None and request.get('html_path'):
+        with open(request['html_path'], 'rb') as f:
+            page_html = response_text({'url': url, 'body': f.read(), 'content_type': ''})
+    if page_html is None:
+        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
+        response = await http_get(session, url, headers=headers, timeout=15)
+        if response['status'] != 200:
+            raise ValueError(f"HTTP {response['status']}")
+        page_html = response_text(response)
+    timings['fetch_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    
+    og_meta = find_og_meta(page_html)
+    title = request.get('title') or og_meta.get('og:title') or html_title(page_html)
+    description = request.get('description') or og_meta.get('og:description', '')
+    
+    step = time.perf_counter()
+    text = extract_complete_text_from_html(page_html, title, url or None)
+    timings['extract_ms'] = round((time.perf_counter() - step) * 1000, 1)
+    
+    step = time.perf_counter()
+    caption = format_news_live_piter_style(title, description, text)
+    timings['format_ms'] = round((time.perf_counter() - step) * 1000, 1)
+    
+    image = request.get('image') or og_meta.get('og:image')
+    timings['total_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    return {
+        'title': title,
+        'caption': caption,
+        'word_count': len(caption.split()),
+        'image': image if is_image_url(image) else None,
+        'timings': timings
+    }
+
+async def run_batch(input_path, output_path, workers=4):
+    """Пакетный режим: записи обрабатываются параллельно, результаты пишутся по мере готовности"""
+    with open(input_path, 'r', encoding='utf-8') as f:
+        requests = [json.loads(line) for line in f if line.strip()]
+    
+    pending = asyncio.Queue()
+    for index, request in enumerate(requests):
+        pending.put_nowait((index, request))
+    stats = {'ok': 0, 'failed': 0}
+    started = time.perf_counter()
+    
+    async def batch_worker(session, output):
+        while not pending.empty():
+            index, request = pending.get_nowait()
+            result = {'index': index, 'url': request.get('url')}
+            try:
+                result.update(await process_batch_item(session, request))
+                stats['ok'] += 1
+            except Exception as e:
+                result['error'] = str(e)
+                stats['failed'] += 1
+            output.write(json.dumps(result, ensure_ascii=False) + '\n')
+    
+    try:
+        session = get_http_session()
+        with open(output_path, 'w', encoding='utf-8') as output:
+            await asyncio.gather(*(batch_worker(session, output) for _ in range(max(workers, 1))))
+    finally:
+        await close_http_session()
+    
+    elapsed = time.perf_counter() - started
+    log.info(f"Пакет обработан: {stats['ok']} успешно, {stats['failed']} с ошибкой за {elapsed:.1f} с",
+             extra={'fields': {'items': len(requests), 'ok': stats['ok'], 'failed': stats['failed'],
+                               'seconds': round(elapsed, 2),
+                               'items_per_second': round(len(requests) / elapsed, 2) if elapsed else None}})
+
+# --- Пробный прогон: автопостинг по виртуальным часам без отправки в Telegram ---
+class TelegramSink:
+    """Замена клиента Telegram: подписи и картинки сохраняются в локальную папку"""
+
+    def __init__(self, directory, keep_images=True):
+        self.directory = directory
+        self.keep_images = keep_images
+        self.sent = 0
+        os.makedirs(directory, exist_ok=True)
+        self.log_path = os.path.join(directory, 'sent.jsonl')
+        open(self.log_path, 'w').close()
+
+    async def send_photo(self, chat_id, photo, caption=None, parse_mode=None, **kwargs):
+        # Проверка, которую сделал бы Telegram: длина подписи после разбора HTML
+        visible = html.unescape(re.sub(r'<[^>]+>', '', caption or '')) if parse_mode == 'HTML' else caption or ''
+        if utf16_len(visible) > CAPTION_LIMIT:
+            raise ValueError(f"Bad Request: message caption is too long ({utf16_len(visible)})")
+        self.sent += 1
+        entry = {'n': self.sent, 'at': clock.now().isoformat(), 'chat_id': chat_id,
+                 'caption': caption, 'parse_mode': parse_mode}
+        if isinstance(photo, str):
+            entry['file_id'] = photo
+        elif self.keep_images:
+            entry['file_id'] = f"sim-{self.sent}"
+            entry['image_file'] = os.path.join(self.directory, f"{self.sent:04d}.jpg")
+            with open(entry['image_file'], 'wb') as f:
+                f.write(photo.read())
+        else:
+            entry['file_id'] = f"sim-{self.sent}"
+            photo.read()
+        with open(self.log_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        
+        return SimpleNamespace(photo=[SimpleNamespace(file_id=entry['file_id'])])
+
+    async def reply_to(self, message, text, **kwargs):
+        log.info(f"Ответ (пробный прогон): {text[:100]}")
+
+def prepare_dry_run(output_dir, keep_images=True):
+    """Общая подготовка пробных прогонов: отдельная база состояния, пустой список опубликованного,
+    приемник вместо Telegram; возвращает начало текущих суток по Москве для виртуальных часов"""
+    global bot, DRY_RUN, posted_news, STATE_DB_PATH
+    DRY_RUN = True
+    # Водяные знаки и пул кандидатов - в отдельной базе прогона, рабочее состояние не меняется
+    os.makedirs(output_dir, exist_ok=True)
+    STATE_DB_PATH = os.path.join(output_dir, 'state.sqlite3')
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(STATE_DB_PATH + suffix):
+            os.remove(STATE_DB_PATH + suffix)
+    configure_channels()
+    posted_news = set()
+    initialize_placeholder()
+    bot = TelegramSink(output_dir, keep_images=keep_images)
+    METRICS.clear()
+    return (datetime.now(timezone.utc) + timedelta(hours=3)).replace(
+        hour=0, minute=0, second=0, microsecond=0) - timedelta(hours=3)
+
+async def simulate(days=1, output_dir='./simulation'):
+    """Прогон auto_poster за days суток виртуального времени с начала текущих суток по Москве"""
+    global clock
+    import tracemalloc
+    
+    moscow_midnight = prepare_dry_run(output_dir)
+    clock = VirtualClock(moscow_midnight, until=moscow_midnight + timedelta(days=days))
+    reset_daily_stats()
+    
+    tracemalloc.start()
+    started = time.perf_counter()
+    poster = asyncio.create_task(auto_poster())
+    try:
+        await asyncio.wait([poster, asyncio.create_task(clock.reached_until.wait())],
+                           return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        poster.cancel()
+        await close_http_session()
+    elapsed = time.perf_counter() - started
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    
+    posts = METRICS['posts']
+    summary = {
+        'simulated_days': days,
+        'wall_seconds': round(elapsed, 2),
+        'posts': posts,
+        'items_prepared': METRICS['items_prepared'],
+        'items_per_second': round(METRICS['items_prepared'] / elapsed, 2) if elapsed else None,
+        'http_requests': METRICS['http_requests'],
+        'fetches_per_post': round(METRICS['http_requests'] / posts, 2) if posts else None,
+        'wasted_fetches_per_post': round(METRICS['wasted_fetches'] / posts, 2) if posts else None,
+        'peak_memory_mb': round(peak_memory / 1024 / 1024, 2)
+    }
+    with open(os.path.join(output_dir, 'summary.json'), 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    log.info(f"Пробный прогон завершен: {posts} публикаций за {days} сут. виртуального времени",
+             extra={'fields': summary})
+    return summary
+
+# --- Нагрузочный прогон: тысячи ускоренных циклов на локальных данных с контролем роста ресурсов ---
+SOAK_FEEDS = 3
+SOAK_ITEM_INTERVAL = 600        # новая запись в каждой ленте раз в 10 минут виртуального времени
+SOAK_SAMPLES = 20               # замеров ресурсов за прогон
+SOAK_MEMORY_TOLERANCE_MB = 2.0  # допустимый прирост памяти после разогрева
+SOAK_FILES_TOLERANCE = 5        # допустимый прирост открытых дескрипторов после разогрева
+SOAK_RSS_TOLERANCE_MB = 4.0     # допустимый прирост RSS (ловит и рост вне Python: SQLite, буферы aiohttp)
+SOAK_STREETS = ('Невском проспекте', 'Васильевском острове', 'Петроградской стороне', 'Московском проспекте',
+                'Литейном проспекте', 'Охте', 'Лиговском проспекте', 'Крестовском острове')
+SOAK_PARAGRAPHS = (
+    'По словам очевидцев, первые сообщения о случившемся появились в городских пабликах около полудня.',
+    'На месте работают экстренные службы, движение транспорта на соседних улицах частично ограничено.',
+    'В администрации района пообещали разобраться в причинах и сообщить подробности в ближайшее время.',
+    'Жители соседних домов рассказали, что похожие ситуации уже возникали здесь прошлой осенью.',
+    'Городские власти рекомендуют водителям заранее планировать маршрут и учитывать возможные задержки.'
+)
+
+def create_soak_app(started):
+    """Локальные данные прогона: ленты, пополняемые по виртуальным часам, страницы статей и картинки"""
+    from aiohttp import web
+    
+    def item_title(feed, number):
+        return f"Происшествие №{number} на {SOAK_STREETS[(number + feed) % len(SOAK_STREETS)]} в Петербурге, лента {feed}"
+    
+    async def feed(request):
+        feed_number = int(request.match_info['feed'])
+        latest = int((clock.now() - started).total_seconds() // SOAK_ITEM_INTERVAL)
+        base = f"{request.scheme}://{request.host}"
+        items = ''.join(
+            f"<item><title>{item_title(feed_number, number)}</title>"
+            f"<link>{base}/news/{feed_number}/{number}</link>"
+            f"<pubDate>{format_datetime(started + timedelta(seconds=number * SOAK_ITEM_INTERVAL))}</pubDate>"
+            f"<description>Подробности происшествия №{number}.</description></item>"
+            for number in range(latest, max(latest - 10, -1), -1))
+        return web.Response(text=f'<?xml version="1.0" encoding="utf-8"?><rss><channel>{items}</channel></rss>',
+                            content_type='application/rss+xml')
+    
+    async def article(request):
+        feed_number, number = int(request.match_info['feed']), int(request.match_info['number'])
+        base = f"{request.scheme}://{request.host}"
+        paragraphs = ''.join(f"<p>{paragraph}</p>" for paragraph in SOAK_PARAGRAPHS)
+        return web.Response(
+            text=f'<html><head><meta property="og:image" content="{base}/img/{feed_number}/{number}.jpg"></head>'
+                 f'<body><article><h1>{item_title(feed_number, number)}</h1>{paragraphs}</article></body></html>',
+            content_type='text/html')
+    
+    async def image(request):
+        return web.Response(body=bytes(20480), content_type='image/jpeg')
+    
+    app = web.Application()
+    app.router.add_get('/feed/{feed}.xml', feed)
+    app.router.add_get('/news/{feed}/{number}', article)
+    app.router.add_get('/img/{feed}/{number}.jpg', image)
+    return app
+
+def soak_growth(samples, key):
+    """Прирост показателя во второй половине прогона (первая половина - разогрев кэшей)"""
+    values = [sample[key] for sample in samples[len(samples) // 2:] if sample.get(key) is not None]
+    return round(values[-1] - values[0], 2) if len(values) > 1 else 0
+
+async def soak(cycles=2000, output_dir='./soak'):
+    """Нагрузочный прогон: cycles циклов публикации по виртуальным часам на локальных лентах
+    
+    Не пройден, если после разогрева продолжают расти память, дескрипторы или временные файлы"""
+    global clock, posted_news, NEWS_SOURCES, SOURCE_REGISTRY
+    import gc
+    import tracemalloc
+    from aiohttp import web
+    
+    started = prepare_dry_run(output_dir, keep_images=False)
+    clock = VirtualClock(started)
+    reset_daily_stats()
+    # Опубликованное - в том же хранилище, что и в работе: проверяется и его ротация по виртуальным часам
+    posted_news = PostedStore(get_state_db(), POSTED_FILTER_CAPACITY, POSTED_RETENTION_DAYS)
+    # Тысячи циклов дают сотни тысяч строк INFO - в прогоне оставляем предупреждения и ошибки
+    log.setLevel(max(log.level, logging.WARNING))
+    
+    runner = web.AppRunner(create_soak_app(started))
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 0).start()
+    port = runner.addresses[0][1]
+    SOURCE_REGISTRY = {source['url']: source for source in (
+        normalize_source({'url': f"http://127.0.0.1:{port}/feed/{feed}.xml", 'region': 'spb'})
+        for feed in range(SOAK_FEEDS))}
+    NEWS_SOURCES = list(SOURCE_REGISTRY)
+    
+    samples = []
+    sample_every = max(cycles // SOAK_SAMPLES, 1)
+    tracemalloc.start()
+    wall_started = time.perf_counter()
+    try:
+        for cycle in range(1, cycles + 1):
+            await publish_news(1)
+            clock.current += timedelta(seconds=PUBLISH_MIN_INTERVAL)
+            if cycle % sample_every == 0:
+                gc.collect()
+                samples.append(dict(memory_sample(), cycle=cycle))
+    finally:
+        tracemalloc.stop()
+        await close_http_session()
+        await runner.cleanup()
+    
+    growth = {key: soak_growth(samples, key) for key in ('traced_mb', 'rss_mb', 'open_files', 'temp_images')}
+    failures = []
+    if growth['traced_mb'] > SOAK_MEMORY_TOLERANCE_MB:
+        failures.append(f"память выросла на {growth['traced_mb']} МБ")
+    if growth['rss_mb'] > SOAK_RSS_TOLERANCE_MB:
+        failures.append(f"RSS процесса вырос на {growth['rss_mb']} МБ")
+    if growth['open_files'] > SOAK_FILES_TOLERANCE:
+        failures.append(f"открытых дескрипторов стало больше на {growth['open_files']}")
+    if growth['temp_images'] > 0:
+        failures.append(f"временных картинок стало больше на {growth['temp_images']}")
+    
+    summary = {
+        'cycles': cycles,
+        'simulated_days': round((clock.now() - started).total_seconds() / 86400, 1),
+        'wall_seconds': round(time.perf_counter() - wall_started, 2),
+        'posts': METRICS['posts'],
+        'http_requests': METRICS['http_requests'],
+        'growth': growth,
+        'passed': not failures,
+        'failures': failures,
+        'samples': samples
+    }
+    with open(os.path.join(output_dir, 'summary.json'), 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    if failures:
+        log.error(f"Нагрузочный прогон не пройден: {'; '.join(failures)}", extra={'fields': growth})
+    else:
+        log.warning(f"Нагрузочный прогон пройден: {cycles} циклов, {METRICS['posts']} публикаций",
+                    extra={'fields': growth})
+    return summary
+
+# --- Воркеры предварительной загрузки ---
+def get_shard_sources(shard_index, shard_count):
+    """Источники шарда (стабильное разбиение по crc32 URL)"""
+    return [source for source in NEWS_SOURCES
+            if zlib.crc32(source.encode('utf-8')) % shard_count == shard_index]
+
+async def source_poller(sources, prepare_text=False):
+    """Опрос источников, каждого по своему интервалу: новые записи сразу попадают в пул кандидатов
+    
+    prepare_text - режим воркера: тексты статей извлекаются заранее, источник отмечается обработанным"""
+    semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+    
+    async def poll(session, source):
+        async with semaphore:
+            polled = await poll_source(session, source)
+            if polled is None:
+                return
+            items = polled
+            if prepare_text:
+                items = [item for item in polled if item.link and item.news_id not in posted_news]
+                for item in items:
+                    item.text = await get_extended_news_text(item.link, item.title, session)
+            store_candidates(source, items, mark_fetched=prepare_text, seen=polled)
+            log.debug("%s: сохранено %d кандидатов", source, len(items))
+    
+    while True:
+        new_cycle_id('poll')
+        try:
+            session = get_http_session()
+            due = due_sources(sources)
+            if not prepare_text:
+                # Источники, которые ведут воркеры, лидер не опрашивает
+                prefetched = fresh_worker_sources(due)
+                due = [source for source in due if source not in prefetched]
+            results = await asyncio.gather(*(poll(session, source) for source in due), return_exceptions=True)
+            for source, result in zip(due, results):
+                if isinstance(result, Exception):
+                    log.warning(f"Ошибка опроса {source}: {result}")
+            # Спим до ближайшего срока опроса
+            next_polls = [row[3] for source, row in get_source_schedule().items() if source in sources]
+            delay = min(next_polls, default=0) - clock.now().timestamp()
+        except Exception as e:
+            log.warning(f"Ошибка опроса источников: {e}")
+            delay = SOURCE_POLL_MIN
+        await clock.sleep(min(max(delay, 5), SOURCE_POLL_MAX))
+
+async def prefetch_worker(shard_index, shard_count):
+    """Воркер: опрашивает свой шард источников, извлекает тексты и кладет кандидатов в общее хранилище"""
+    sources = get_shard_sources(shard_index, shard_count)
+    log.info(f"Воркер {shard_index}/{shard_count}: {len(sources)} источников")
+    await source_poller(sources, prepare_text=True)
+
+async def worker_main(shard_index, shard_count):
+    """Запуск процесса-воркера (без Telegram и без публикации)"""
+    global posted_news
+    # Общая таблица опубликованных - уже опубликованное воркер не готовит
+    posted_news = load_posted_news()
+    log.info(f"Запуск воркера {shard_index}/{shard_count} (процесс {INSTANCE_ID})")
+    try:
+        await prefetch_worker(shard_index, shard_count)
+    finally:
+        await close_http_session()
+        close_feed_parse_pool()
+
+def bootstrap():
+    """Загрузка .env, чтение конфигурации и запуск логирования - общее для всех режимов"""
+    load_dotenv()
+    read_config()
+    setup_logging()
+    configure_sources()
+
+def startup():
+    """Подготовка публикующего процесса: проверки, папки, клиент Telegram, сигналы
+    
+    Состояние загружается только после получения аренды (load_state в main)"""
+    validate_config()
+    if not os.path.exists('./static'):
+        os.makedirs('./static')
+        log.info("Создана папка static")
+    create_bot()
+    install_signal_handlers()
+    if MEMORY_TRACE_FRAMES:
+        import tracemalloc
+        tracemalloc.start(MEMORY_TRACE_FRAMES)
 
 async def main():
     """Основная функция запуска бота"""
-    print("🚀 Запуск новостного бота 'Live Питер 📸' ВЕРСИЯ 7.7...")
-    print(f"📰 Источников: {len(NEWS_SOURCES)}")
-    print(f"🎯 Формат: компактные новости (2-3 абзаца)")
-    print(f"⏰ Расписание: 1-2 новости в час (07:00-23:50 МСК)")
-    print(f"🌐 Внешний URL: {RENDER_APP_URL or 'Не установлен'}")
-    print(f"📺 Канал: {CHANNEL_ID}")
-    print(f"🖼️ Система изображений: ПРИОРИТЕТ КАРТИНКАМ ИЗ НОВОСТЕЙ")
-    print(f"🔒 Защита от дублирования: ✅ АКТИВНА")
-    print(f"📊 Дневной лимит: {MAX_DAILY_POSTS} постов")
-    print(f"⏰ Время постинга: 07:00-23:50 (МСК)")
-    print(f"🧹 Очистка пробелов: ✅ УЛУЧШЕННАЯ")
+    startup()
+    log.info("Запуск новостного бота 'Live Питер 📸' ВЕРСИЯ 7.7", extra={'fields': {
+        'sources': len(NEWS_SOURCES),
+        'channels': [channel['id'] for channel in CHANNELS],
+        'max_daily_posts': MAX_DAILY_POSTS,
+        'posting_window': DEFAULT_POSTING_WINDOW,
+        'render_url': RENDER_APP_URL or None,
+        'telegram_mode': TELEGRAM_MODE,
+        'http_archive': HTTP_ARCHIVE_MODE or None,
+        'log_level': LOG_LEVEL
+    }})
     
     # Инициализируем заглушку
     placeholder_available = initialize_placeholder()
     
     if not placeholder_available:
-        print("❌ КРИТИЧЕСКАЯ ОШИБКА: Заглушка не найдена!")
-        print("💡 Разместите файл placeholder.jpg в папке static")
-        print("🚫 Бот запущен, но публикация невозможна без заглушки")
-    
-    # Запускаем HTTP сервер для здоровья
-    health_runner = await health_server()
+        log.error("КРИТИЧЕСКАЯ ОШИБКА: Заглушка не найдена! Бот запущен, но публикация невозможна без placeholder.jpg в папке static")
     
+    health_runner = None
+    heartbeat_task = None
     try:
+        # Публикует только лидер; остальные процессы ждут освобождения аренды
+        await wait_for_leadership()
+        
+        # Опубликованное, счетчики и кэши читаем только сейчас: пока процесс был резервным,
+        # прежний лидер продолжал публиковать, и загруженное при старте состояние устарело бы
+        load_state()
+        
+        # HTTP сервер (здоровье, webhook) и пульс - только у лидера: резервный процесс на том же
+        # хосте (аренда в локальном SQLite) иначе не смог бы занять PORT
+        health_runner = await health_server()
+        heartbeat_task = asyncio.create_task(heartbeat())
+        
         # Запускаем ВСЕ задачи
         tasks = [
-            asyncio.create_task(bot.polling(non_stop=True)),
             asyncio.create_task(auto_poster()),
-            asyncio.create_task(enhanced_keep_alive())
+            asyncio.create_task(source_poller(NEWS_SOURCES)),
+            asyncio.create_task(enhanced_keep_alive()),
+            asyncio.create_task(memory_monitor()),
+            asyncio.create_task(lease_keeper())
         ]
         
-        print("✅ Все задачи запущены")
+        if TELEGRAM_MODE == 'webhook':
+            # Обновления приходят на HTTP сервер - постоянный long-poll не нужен
+            await bot.set_webhook(url=f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET)
+            log.info(f"Webhook установлен: {WEBHOOK_URL}{WEBHOOK_PATH}")
+        else:
+            # getUpdates не работает, пока установлен webhook
+            await bot.delete_webhook()
+            tasks.append(asyncio.create_task(bot.polling(non_stop=True)))
+        
+        log.info("Все задачи запущены")
+        mark_startup('ready_ms')
         await asyncio.gather(*tasks)
         
     except Exception as e:
-        print(f"💥 Ошибка: {e}")
+        log.error(f"Ошибка: {e}")
     finally:
-        await health_runner.cleanup()
-        if instance_socket:
-            instance_socket.close()
+        await close_http_session()
+        close_feed_parse_pool()
+        if heartbeat_task:
+            heartbeat_task.cancel()
+        if health_runner:
+            await health_runner.cleanup()
+        save_state_on_exit()
+
+def parse_args():
+    """Разбор аргументов командной строки"""
+    parser = argparse.ArgumentParser(description="Новостной бот для канала 'Live Питер 📸'")
+    parser.add_argument('--worker', action='store_true',
+                        help="режим воркера: только предварительная загрузка своего шарда источников")
+    parser.add_argument('--shard', default='0/1',
+                        help="шард воркера в виде номер/всего, например 0/2")
+    parser.add_argument('--bench-extract', type=int, metavar='N', default=0,
+                        help="замерить извлечение текста по страницам HTTP-архива (N повторов) и выйти")
+    parser.add_argument('--batch', metavar='INPUT',
+                        help="пакетный режим: JSONL с url (или html/html_path, title, description, image) на строку")
+    parser.add_argument('--batch-output', metavar='OUTPUT', default='batch_results.jsonl',
+                        help="куда писать результаты пакетного режима (JSONL)")
+    parser.add_argument('--batch-workers', type=int, metavar='N', default=4,
+                        help="число параллельных обработчиков пакетного режима")
+    parser.add_argument('--simulate', type=int, metavar='DAYS', default=0,
+                        help="пробный прогон автопостинга за DAYS суток виртуального времени без отправки в Telegram")
+    parser.add_argument('--simulate-output', metavar='DIR', default='./simulation',
+                        help="папка для подписей, картинок и итогов пробного прогона")
+    parser.add_argument('--soak', type=int, metavar='CYCLES', default=0,
+                        help="нагрузочный прогон: CYCLES ускоренных циклов публикации на локальных лентах; "
+                             "код выхода 1, если память или временные файлы продолжают расти")
+    parser.add_argument('--soak-output', metavar='DIR', default='./soak',
+                        help="папка для итогов нагрузочного прогона")
+    return parser.parse_args()
+
+STARTUP_TIMINGS['import_ms'] = round((time.perf_counter() - STARTUP_STARTED) * 1000, 1)
 
 if __name__ == "__main__":
+    args = parse_args()
+    bootstrap()
+    log.info(f"Модуль загружен за {STARTUP_TIMINGS['import_ms']} мс", extra={'fields': {'import_ms': STARTUP_TIMINGS['import_ms']}})
     try:
-        asyncio.run(main())
+        if args.bench_extract:
+            bench_extract(args.bench_extract)
+        elif args.batch:
+            asyncio.run(run_batch(args.batch, args.batch_output, args.batch_workers))
+        elif args.simulate:
+            asyncio.run(simulate(args.simulate, args.simulate_output))
+        elif args.soak:
+            if not asyncio.run(soak(args.soak, args.soak_output))['passed']:
+                sys.exit(1)
+        elif args.worker:
+            shard_index, shard_count = map(int, args.shard.split('/'))
+            asyncio.run(worker_main(shard_index, shard_count))
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
-        print("👋 Бот остановлен")
-        save_posted_news(posted_news)
-        save_daily_stats()
-        if instance_socket:
-            instance_socket.close()
+        log.info("Бот остановлен")
+        save_state_on_exit()
     except Exception as e:
-        print(f"💥 Фатальная ошибка: {e}")
-        save_posted_news(posted_news)
-        save_daily_stats()
-        if instance_socket:
-            instance_socket.close()
+        log.error(f"Фатальная ошибка: {e}")
+        save_state_on_exit()
 
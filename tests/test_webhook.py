@@ -0,0 +1,74 @@
+"""Webhook-режим: синтетические обновления Telegram на маршрут HTTP сервера"""
+import asyncio
+import os
+import sys
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot as live_bot
+
+LIMITS_UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 5,
+        "date": 1760000000,
+        "chat": {"id": 42, "type": "private"},
+        "from": {"id": 42, "is_bot": False, "first_name": "Test"},
+        "text": "/limits",
+        "entities": [{"type": "bot_command", "offset": 0, "length": 7}]
+    }
+}
+
+
+@pytest.fixture
+def webhook_bot(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("BOT_TOKEN", "123:abc")
+    monkeypatch.setenv("TELEGRAM_MODE", "webhook")
+    monkeypatch.setenv("WEBHOOK_URL", "https://example.invalid")
+    monkeypatch.delenv("WEBHOOK_SECRET", raising=False)
+    monkeypatch.delenv("CHANNELS", raising=False)
+    live_bot.read_config()
+    live_bot.configure_channels()
+    live_bot.create_bot()
+
+    replies = []
+
+    async def fake_reply(message, text, **kwargs):
+        replies.append((message.chat.id, text))
+
+    monkeypatch.setattr(live_bot.bot, "reply_to", fake_reply)
+    monkeypatch.setattr(live_bot, "IS_LEADER", True)
+    yield replies
+    live_bot.bot = None
+
+
+def post_update(headers):
+    async def run():
+        async with TestClient(TestServer(live_bot.create_web_app())) as client:
+            response = await client.post(live_bot.WEBHOOK_PATH, json=LIMITS_UPDATE, headers=headers)
+            await asyncio.gather(*live_bot.WEBHOOK_TASKS)
+            return response.status
+    return asyncio.run(run())
+
+
+def test_wrong_secret_is_rejected(webhook_bot):
+    assert post_update({"X-Telegram-Bot-Api-Secret-Token": "wrong"}) == 403
+    assert webhook_bot == []
+
+
+def test_standby_asks_telegram_to_retry(webhook_bot, monkeypatch):
+    monkeypatch.setattr(live_bot, "IS_LEADER", False)
+    assert post_update({"X-Telegram-Bot-Api-Secret-Token": live_bot.WEBHOOK_SECRET}) == 503
+    assert webhook_bot == []
+
+
+def test_update_reaches_command_handler(webhook_bot):
+    assert post_update({"X-Telegram-Bot-Api-Secret-Token": live_bot.WEBHOOK_SECRET}) == 200
+    assert len(webhook_bot) == 1
+    chat_id, text = webhook_bot[0]
+    assert chat_id == 42
+    assert "Лимиты" in text